@@ -0,0 +1,195 @@
+# ===================================================================================
+# BENCHMARK END-TO-END BOT DENGAN PENGGANTI LOKAL (TANPA JARINGAN / API KEY)
+# Menjalankan handler rag.py (handle_document, handle_message, list_docs,
+# summarize_document, export_chat) untuk sejumlah pengguna sintetis secara
+# bersamaan, dengan Telegram, Gemini, dan Supabase diganti oleh benchmarks/fakes.py.
+# Melaporkan throughput ingest (potongan/detik) dan latensi p50/p95/p99 per handler.
+# Ambang --max-answer-p95 / --min-chunks-per-sec membuat skrip keluar dengan kode 1
+# jika terlampaui, sehingga bisa dipakai di CI untuk mendeteksi regresi.
+#
+#   python benchmarks/bench_bot.py --users 8 --pages 20 --questions 5
+# ===================================================================================
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fitz  # PyMuPDF
+from fakes import FakeApplication, FakeBot, FakeEmbedder, FakeModel, FakeSupabase, echo_question
+
+TOPICS = ["pendapatan", "biaya", "investasi", "risiko", "pelanggan", "produksi", "logistik", "pajak",
+          "karyawan", "teknologi", "pemasaran", "regulasi", "energi", "kualitas", "anggaran", "strategi"]
+FILLER = ("perusahaan laporan tahun periode meningkat menurun dibandingkan sebelumnya utama "
+          "analisis data proyek unit divisi target realisasi rencana kebijakan program").split()
+ERROR_PREFIXES = ("Terjadi kesalahan", "Error", "Gagal", "Maaf, terjadi kesalahan")
+
+def make_text(rng: random.Random, topic: str, words: int) -> str:
+    return " ".join(topic if rng.random() < 0.1 else rng.choice(FILLER) for _ in range(words)) + "."
+
+def make_pdf(path: str, pages: int, rng: random.Random, topics: list):
+    doc = fitz.open()
+    for p in range(pages):
+        page = doc.new_page()
+        text = "\n".join(make_text(rng, topics[p % len(topics)], 60) for _ in range(8))
+        page.insert_textbox(fitz.Rect(40, 40, 560, 800), f"Halaman {p + 1}\n{text}", fontsize=8)
+    doc.save(path)
+
+def make_txt(path: str, paragraphs: int, rng: random.Random, topics: list):
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(paragraphs):
+            f.write(make_text(rng, topics[i % len(topics)], 80) + "\n\n")
+
+def percentiles(values: list) -> dict:
+    from rag import percentile
+    return {'count': len(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99)}
+
+async def timed(latencies: dict, name: str, coro):
+    start = time.perf_counter()
+    await coro
+    latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+async def run_user(rag, app: FakeApplication, user_id: int, args, files: list, latencies: dict, ingest_spans: list):
+    rng = random.Random(user_id)
+    for source, file_name in files:
+        start = time.perf_counter()
+        update, context = app.upload(user_id, source, file_name)
+        await rag.handle_document(update, context)
+        task = context.user_data.get('processing_task')
+        if task:
+            await task
+        ingest_spans.append((start, time.perf_counter()))
+        latencies.setdefault('ingest', []).append(time.perf_counter() - start)
+
+    topics = [TOPICS[(user_id + i) % len(TOPICS)] for i in range(3)]
+    for _ in range(args.questions):
+        question = f"{rng.choice(topics)} " + " ".join(rng.sample(FILLER, 5)) + "?"
+        update, context = app.make_update(user_id, text=question)
+        await timed(latencies, 'answer', rag.handle_message(update, context))
+
+    update, context = app.make_update(user_id, text='/list_docs')
+    await timed(latencies, 'list_docs', app.command('list_docs')(update, context))
+    update, context = app.make_update(user_id, text='/summarize')
+    await timed(latencies, 'summarize', app.command('summarize')(update, context))
+    update, context = app.make_update(user_id, text='/export')
+    await timed(latencies, 'export', app.command('export')(update, context))
+
+async def run(rag, args, workdir: str) -> dict:
+    store = FakeSupabase(args.db_latency)
+    embedder = FakeEmbedder(args.embed_latency, args.embed_item_latency)
+    if rag.VECTOR_STORE == 'supabase':
+        rag.supabase = store
+    rag.genai = types.SimpleNamespace(embed_content=embedder)  # google.generativeai tidak perlu diimpor
+    rag.multimodal_model = FakeModel('flash', args.flash_latency)
+    rag.refine_model = FakeModel('flash', args.flash_latency, respond=echo_question)
+    rag.summary_model = FakeModel('flash', args.flash_latency)
+    rag.generative_model = FakeModel('pro', args.pro_latency)
+
+    app = FakeApplication(FakeBot(args.bot_latency))
+    rag.register_handlers(app)
+
+    files = {}
+    for user_id in range(1, args.users + 1):
+        rng = random.Random(1000 + user_id)
+        topics = [TOPICS[(user_id + i) % len(TOPICS)] for i in range(3)]
+        pdf_path = os.path.join(workdir, f"src_{user_id}.pdf")
+        txt_path = os.path.join(workdir, f"src_{user_id}.txt")
+        make_pdf(pdf_path, args.pages, rng, topics)
+        make_txt(txt_path, args.paragraphs, rng, topics)
+        files[user_id] = [(pdf_path, f"laporan_{user_id}.pdf"), (txt_path, f"catatan_{user_id}.txt")]
+
+    latencies, ingest_spans = {}, []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_user(rag, app, user_id, args, files[user_id], latencies, ingest_spans)
+                           for user_id in files))
+    wall = time.perf_counter() - start
+
+    chunks = 0
+    for user_id in files:
+        entries = await rag.document_catalog.entries(str(user_id))
+        chunks += sum(entry['chunk_count'] for entry in entries.values())
+    ingest_wall = max(end for _, end in ingest_spans) - min(begin for begin, _ in ingest_spans)
+    errors = [text for method, payload in app.bot.sent if method == 'send_message'
+              for text in [payload[1]] if text.startswith(ERROR_PREFIXES)]
+    return {
+        'users': args.users, 'wall_seconds': wall,
+        'ingest': {'chunks': chunks, 'seconds': ingest_wall, 'chunks_per_sec': chunks / ingest_wall if ingest_wall else 0.0},
+        'latency': {name: percentiles(values) for name, values in latencies.items()},
+        'calls': {'embed': embedder.calls, 'embed_items': embedder.items, 'db': store.calls,
+                  'flash': rag.multimodal_model.calls + rag.refine_model.calls + rag.summary_model.calls,
+                  'pro': rag.generative_model.calls, 'bot': app.bot.counts},
+        'errors': errors,
+    }
+
+def report(result: dict):
+    ingest = result['ingest']
+    print(f"Pengguna: {result['users']}, total waktu: {result['wall_seconds']:.2f} s")
+    print(f"Ingest : {ingest['chunks']} potongan dalam {ingest['seconds']:.2f} s = {ingest['chunks_per_sec']:.1f} potongan/detik")
+    print(f"{'handler':<10} {'n':>5} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10}")
+    for name, stats in result['latency'].items():
+        print(f"{name:<10} {stats['count']:>5} {stats['p50'] * 1000:>10.0f} {stats['p95'] * 1000:>10.0f} {stats['p99'] * 1000:>10.0f}")
+    print(f"Panggilan: {json.dumps(result['calls'])}")
+    if result['errors']:
+        print(f"Kesalahan ({len(result['errors'])}): {result['errors'][:3]}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--pages', type=int, default=20, help="Halaman PDF per pengguna")
+    parser.add_argument('--paragraphs', type=int, default=40, help="Paragraf TXT per pengguna")
+    parser.add_argument('--questions', type=int, default=5, help="Pertanyaan per pengguna")
+    parser.add_argument('--store', choices=['supabase', 'local'], default='supabase')
+    parser.add_argument('--embed-latency', type=float, default=0.05)
+    parser.add_argument('--embed-item-latency', type=float, default=0.0005)
+    parser.add_argument('--flash-latency', type=float, default=0.3)
+    parser.add_argument('--pro-latency', type=float, default=1.0)
+    parser.add_argument('--db-latency', type=float, default=0.01)
+    parser.add_argument('--bot-latency', type=float, default=0.02)
+    parser.add_argument('--json', help="Tulis hasil lengkap ke file JSON")
+    parser.add_argument('--max-answer-p95', type=float, help="Gagal (kode 1) jika p95 jawaban melebihi nilai ini (detik)")
+    parser.add_argument('--min-chunks-per-sec', type=float, help="Gagal (kode 1) jika throughput ingest di bawah nilai ini")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Konfigurasi harus diset sebelum rag diimpor
+        os.environ.update({
+            'VECTOR_STORE': args.store, 'LOCAL_STORE_DIR': os.path.join(workdir, 'vector_store'),
+            'HISTORY_DIR': os.path.join(workdir, 'chat_history'), 'CAPTION_CACHE_PATH': '',
+        })
+        cwd = os.getcwd()
+        rag = None
+        os.chdir(workdir)  # handle_document mengunduh file ke direktori kerja
+        try:
+            import rag
+            result = asyncio.run(run(rag, args, workdir))
+        finally:
+            os.chdir(cwd)
+            if rag is not None and rag._process_pool is not None:
+                rag._process_pool.shutdown()
+
+    report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+    failures = []
+    if result['errors']:
+        failures.append(f"{len(result['errors'])} pesan kesalahan dari handler")
+    answer_p95 = result['latency'].get('answer', {}).get('p95', 0.0)
+    if args.max_answer_p95 is not None and answer_p95 > args.max_answer_p95:
+        failures.append(f"p95 jawaban {answer_p95:.2f} s > {args.max_answer_p95:.2f} s")
+    if args.min_chunks_per_sec is not None and result['ingest']['chunks_per_sec'] < args.min_chunks_per_sec:
+        failures.append(f"ingest {result['ingest']['chunks_per_sec']:.1f} < {args.min_chunks_per_sec:.1f} potongan/detik")
+    if failures:
+        print("GAGAL: " + "; ".join(failures))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
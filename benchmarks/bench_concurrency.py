@@ -0,0 +1,101 @@
+# ===================================================================================
+# UJI KONKURENSI: N CHAT BERSAMAAN DILAYANI PARALEL, BUKAN SATU PER SATU
+# Setiap pengguna sintetis mengunggah satu TXT kecil, lalu N pertanyaan (satu per
+# pengguna) dikirim ke handle_message secara bersamaan. Model pro palsu tidur
+# --pro-latency detik di thread (meniru klien Gemini yang sinkron). Jika lapisan
+# eksekusi async bekerja, total waktu mendekati ceil(N / GEMINI_CONCURRENCY) x
+# latensi, jauh di bawah N x latensi. Skrip keluar dengan kode 1 jika total waktu
+# melebihi --max-ratio x N x latensi atau ada handler yang membalas kesalahan.
+#
+#   python benchmarks/bench_concurrency.py --chats 8 --pro-latency 1.0
+# ===================================================================================
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fakes import FakeApplication, FakeBot, FakeEmbedder, FakeModel, echo_question
+
+ERROR_PREFIXES = ("Terjadi kesalahan", "Error", "Gagal", "Maaf, terjadi kesalahan")
+
+async def run(rag, args, workdir: str) -> dict:
+    rag.genai = types.SimpleNamespace(embed_content=FakeEmbedder(args.embed_latency))
+    rag.refine_model = FakeModel('flash', args.flash_latency, respond=echo_question)
+    rag.generative_model = FakeModel('pro', args.pro_latency)
+    app = FakeApplication(FakeBot())
+    rag.register_handlers(app)
+
+    # Setiap chat perlu dokumen agar handle_message sampai ke pemanggilan model
+    for user_id in range(1, args.chats + 1):
+        source = os.path.join(workdir, f"catatan_{user_id}.txt")
+        with open(source, 'w', encoding='utf-8') as f:
+            f.write(f"Proyek logistik nomor {user_id} selesai pada bulan Maret dengan anggaran tetap.\n\n" * 10)
+        update, context = app.upload(user_id, source, f"catatan_{user_id}.txt")
+        await rag.handle_document(update, context)
+        await context.user_data['processing_task']
+
+    latencies = []
+
+    async def ask(user_id: int):
+        update, context = app.make_update(user_id, text=f"Kapan proyek logistik nomor {user_id} selesai dikerjakan?")
+        start = time.perf_counter()
+        await rag.handle_message(update, context)
+        latencies.append(time.perf_counter() - start)
+
+    sent_before = len(app.bot.sent)
+    start = time.perf_counter()
+    await asyncio.gather(*(ask(user_id) for user_id in range(1, args.chats + 1)))
+    wall = time.perf_counter() - start
+    errors = [payload[1] for method, payload in app.bot.sent[sent_before:]
+              if method == 'send_message' and payload[1].startswith(ERROR_PREFIXES)]
+    return {'wall': wall, 'slowest': max(latencies), 'pro_calls': rag.generative_model.calls, 'errors': errors}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=8, help="Jumlah chat yang bertanya bersamaan")
+    parser.add_argument('--embed-latency', type=float, default=0.01)
+    parser.add_argument('--flash-latency', type=float, default=0.05)
+    parser.add_argument('--pro-latency', type=float, default=1.0)
+    parser.add_argument('--max-ratio', type=float, default=0.5,
+                        help="Gagal (kode 1) jika total waktu > rasio ini x chats x pro-latency")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ.update({
+            'VECTOR_STORE': 'local', 'LOCAL_STORE_DIR': os.path.join(workdir, 'vector_store'),
+            'HISTORY_DIR': os.path.join(workdir, 'chat_history'), 'CAPTION_CACHE_PATH': '',
+        })
+        cwd = os.getcwd()
+        rag = None
+        os.chdir(workdir)  # handle_document mengunduh file ke direktori kerja
+        try:
+            import rag
+            result = asyncio.run(run(rag, args, workdir))
+        finally:
+            os.chdir(cwd)
+            if rag is not None and rag._process_pool is not None:
+                rag._process_pool.shutdown()
+
+    serial = args.chats * args.pro_latency
+    print(f"{args.chats} chat bersamaan: total {result['wall']:.2f} s, jawaban terlama {result['slowest']:.2f} s "
+          f"(berurutan >= {serial:.2f} s, {result['pro_calls']} panggilan pro)")
+    failures = []
+    if result['errors']:
+        failures.append(f"{len(result['errors'])} pesan kesalahan dari handler: {result['errors'][:3]}")
+    if result['pro_calls'] < args.chats:
+        failures.append(f"hanya {result['pro_calls']} dari {args.chats} chat memanggil model pro")
+    if result['wall'] > args.max_ratio * serial:
+        failures.append(f"total {result['wall']:.2f} s > {args.max_ratio} x {serial:.2f} s: chat dilayani berurutan")
+    if failures:
+        print("GAGAL: " + "; ".join(failures))
+        sys.exit(1)
+    print("OK: chat dilayani bersamaan")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# ===================================================================================
+# BENCHMARK EKSPOR RIWAYAT KE PDF: PEMOTONG BARIS LAMA VS SATU LINTASAN
+# Membuat riwayat sintetis berisi jawaban panjang lalu membandingkan waktu
+# pembuatan PDF dengan metode lama (get_string_width pada baris yang terus
+# bertambah, lalu tulis ke disk) dan pdf_export.build_history_pdf (tabel lebar
+# glyph di-cache, output langsung ke memori). Tidak membutuhkan API key.
+#
+#   python benchmarks/bench_export.py --entries 200 --answer-words 800
+# ===================================================================================
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fpdf import FPDF
+import pdf_export
+
+WORDS = ("analisis pendapatan operasional proyeksi triwulan laporan kinerja biaya investasi "
+         "pertumbuhan margin likuiditas https://contoh.example/dokumen/laporan-tahunan-2024-lampiran").split()
+
+def make_history(entries: int, answer_words: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    return [{'question': " ".join(rng.choices(WORDS, k=12)) + "?",
+             'answer': " ".join(rng.choices(WORDS, k=answer_words))} for _ in range(entries)]
+
+def export_legacy(history: list, path: str):
+    """Salinan metode lama export_chat (write_manually) sebagai pembanding."""
+    pdf = FPDF()
+    pdf.add_page()
+
+    def write_manually(text, line_height=7):
+        available_width = pdf.w - pdf.l_margin - pdf.r_margin
+        words = text.encode('latin-1', 'replace').decode('latin-1').split(' ')
+        current_line = ""
+        for word in words:
+            if pdf.get_string_width(word) > available_width:
+                if current_line:
+                    pdf.cell(0, line_height, text=current_line, new_x="LMARGIN", new_y="NEXT")
+                    current_line = ""
+                temp_word = ""
+                for char in word:
+                    if pdf.get_string_width(temp_word + char) > available_width:
+                        pdf.cell(0, line_height, text=temp_word, new_x="LMARGIN", new_y="NEXT")
+                        temp_word = char
+                    else:
+                        temp_word += char
+                current_line = temp_word
+                continue
+            separator = ' ' if current_line else ''
+            if pdf.get_string_width(current_line + separator + word) > available_width:
+                pdf.cell(0, line_height, text=current_line, new_x="LMARGIN", new_y="NEXT")
+                current_line = word
+            else:
+                current_line += separator + word
+        if current_line:
+            pdf.cell(0, line_height, text=current_line, new_x="LMARGIN", new_y="NEXT")
+
+    pdf.set_font("Helvetica", 'B', 12)
+    pdf.cell(0, 10, text="Riwayat Percakapan Chatbot", align='C', new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(5)
+    for item in history:
+        pdf.set_font("Helvetica", 'B', 11)
+        write_manually(f"Anda: {item['question']}")
+        pdf.set_font("Helvetica", '', 11)
+        write_manually(f"Bot: {item['answer']}")
+        pdf.ln(5)
+    pdf.output(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    os.remove(path)
+    return data
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=200)
+    parser.add_argument('--answer-words', type=int, default=800)
+    parser.add_argument('--font', default=None, help="Font TTF Unicode (default: cari DejaVu Sans, lalu Helvetica)")
+    args = parser.parse_args()
+
+    history = make_history(args.entries, args.answer_words)
+    regular, _ = pdf_export.find_unicode_font(args.font)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        legacy = export_legacy(history, os.path.join(tmp, 'history.pdf'))
+        legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fast = pdf_export.build_history_pdf(history, args.font)
+    fast_time = time.perf_counter() - start
+
+    print(f"Entri: {args.entries}, kata/jawaban: {args.answer_words}, font baru: {regular or 'Helvetica'}")
+    print(f"lama : {legacy_time:7.2f} s ({len(legacy) / 1024:.0f} KiB)")
+    print(f"baru : {fast_time:7.2f} s ({len(fast) / 1024:.0f} KiB)")
+    print(f"speedup: {legacy_time / fast_time:.2f}x")
+
+if __name__ == '__main__':
+    main()
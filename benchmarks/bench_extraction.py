@@ -0,0 +1,66 @@
+# ===================================================================================
+# BENCHMARK EKSTRAKSI PDF: INLINE VS PROCESS POOL
+# Membuat PDF sintetis lalu mengukur halaman/detik untuk ekstraksi + chunking
+# inline (satu proses, seperti jalur lama) dibandingkan dengan rentang halaman
+# yang dibagi ke process pool. Tidak membutuhkan API key.
+#
+#   python benchmarks/bench_extraction.py --pages 300 --workers 4
+# ===================================================================================
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz  # PyMuPDF
+import extraction
+
+def make_pdf(path: str, pages: int):
+    doc = fitz.open()
+    paragraph = "Laporan kinerja triwulan dengan rincian pendapatan, biaya operasional, dan proyeksi. " * 12
+    for p in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(40, 40, 560, 800), f"Halaman {p + 1}\n" + paragraph * 3, fontsize=8)
+    doc.save(path)
+
+def run_inline(path: str, pages: int) -> int:
+    return sum(len(page['chunks']) for page in extraction.extract_pdf_pages(path, 0, pages, 4096, 64))
+
+def run_pool(path: str, pages: int, workers: int, pages_per_task: int) -> tuple:
+    ranges = [(i, min(i + pages_per_task, pages)) for i in range(0, pages, pages_per_task)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        # Panaskan worker agar waktu start proses tidak ikut terukur
+        list(pool.map(extraction.pdf_page_count, [path] * workers))
+        start = time.perf_counter()
+        futures = [pool.submit(extraction.extract_pdf_pages, path, a, b, 4096, 64) for a, b in ranges]
+        chunks = sum(len(page['chunks']) for future in futures for page in future.result())
+        return chunks, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--pages-per-task', type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.pdf')
+        make_pdf(path, args.pages)
+
+        start = time.perf_counter()
+        inline_chunks = run_inline(path, args.pages)
+        inline_time = time.perf_counter() - start
+
+        pool_chunks, pool_time = run_pool(path, args.pages, args.workers, args.pages_per_task)
+
+    print(f"Halaman: {args.pages}, worker: {args.workers}, halaman/tugas: {args.pages_per_task}")
+    print(f"inline : {args.pages / inline_time:8.1f} halaman/detik ({inline_chunks} potongan, {inline_time:.2f} s)")
+    print(f"pool   : {args.pages / pool_time:8.1f} halaman/detik ({pool_chunks} potongan, {pool_time:.2f} s)")
+    print(f"speedup: {inline_time / pool_time:.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# ===================================================================================
+# BENCHMARK RETRIEVAL: VEKTOR SAJA VS HIBRIDA (VEKTOR + KATA KUNCI + MMR)
+# Korpus sintetis satu pengguna disimpan di FakeSupabase (RPC match_documents dan
+# match_documents_text dengan latensi buatan) atau, dengan --store local, di
+# LocalVectorStore (indeks BM25 di memori). Setiap potongan memuat pengenal unik
+# (mis. INV-2024-0042).
+# Embedding palsu sengaja mengabaikan token yang mengandung angka, meniru model
+# embedding yang tidak membedakan nomor/kode, sehingga terlihat bedanya untuk
+# pertanyaan pengenal. Dilaporkan latensi find_relevant_chunks (p50/p95/p99),
+# waktu membangun indeks BM25 (hanya --store local), jumlah kandidat, dan hit rate
+# potongan target.
+#
+#   python benchmarks/bench_retrieval.py --chunks 5000 --questions 200
+# ===================================================================================
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fakes import FakeSupabase, fake_vector
+
+TOPICS = ["pendapatan", "biaya", "investasi", "risiko", "pelanggan", "produksi", "logistik", "pajak",
+          "karyawan", "teknologi", "pemasaran", "regulasi", "energi", "kualitas", "anggaran", "strategi"]
+FILLER = ("perusahaan laporan tahun periode meningkat menurun dibandingkan sebelumnya utama "
+          "analisis data proyek unit divisi target realisasi rencana kebijakan program").split()
+
+def semantic_vector(text: str) -> list:
+    """Vektor palsu tanpa token berangka: pengenal tidak ikut menentukan kemiripan."""
+    return fake_vector(" ".join(word for word in re.findall(r'\S+', text) if not any(c.isdigit() for c in word)))
+
+class SemanticEmbedder:
+    def __call__(self, model, content, task_type=None, **kwargs):
+        if isinstance(content, list):
+            return {'embedding': [semantic_vector(text) for text in content]}
+        return {'embedding': semantic_vector(content)}
+
+def make_corpus(rng: random.Random, chunks: int, words: int) -> list:
+    rows = []
+    for i in range(chunks):
+        topic = TOPICS[i % len(TOPICS)]
+        identifier = f"INV-{2020 + i % 5}-{i:05d}"
+        body = " ".join(topic if rng.random() < 0.1 else rng.choice(FILLER) for _ in range(words))
+        rows.append({'identifier': identifier, 'topic': topic, 'file_name': f"laporan_{i % 10}.pdf", 'page_number': i // 10 + 1,
+                     'content': f"{body}. Faktur {identifier} untuk {topic} dibayar sebesar Rp{rng.randint(1, 999)} juta."})
+    return rows
+
+async def run_mode(rag, hybrid: bool, questions: list) -> dict:
+    rag.HYBRID_RETRIEVAL = hybrid
+    rag.retrieval_cache.clear()
+    latencies, hits, sizes = [], 0, []
+    for question, target in questions:
+        start = time.perf_counter()
+        chunks = await rag.find_relevant_chunks(question, '1')
+        latencies.append(time.perf_counter() - start)
+        sizes.append(len(chunks))
+        hits += any(target in chunk['content'] for chunk in chunks)
+    from rag import percentile
+    return {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99),
+            'hit_rate': hits / len(questions), 'avg_candidates': sum(sizes) / len(sizes)}
+
+async def run(rag, args) -> dict:
+    store = FakeSupabase(args.db_latency)
+    rag.supabase = store
+    rag.genai = types.SimpleNamespace(embed_content=SemanticEmbedder())
+    rng = random.Random(7)
+    corpus = make_corpus(rng, args.chunks, args.words)
+    await rag.vector_store.insert([{
+        'user_id': '1', 'file_name': row['file_name'], 'page_number': row['page_number'], 'content': row['content'],
+        'embedding': semantic_vector(row['content']), 'content_hash': rag.chunk_hash(row['content'], row['page_number']),
+    } for row in corpus])
+
+    targets = rng.sample(corpus, args.questions)
+    questions = [(f"Berapa nilai faktur {row['identifier']}?", row['identifier']) if i % 2 == 0 else
+                 (f"Bagaimana {row['topic']} " + " ".join(rng.sample(FILLER, 4)) + "?", row['topic'])
+                 for i, row in enumerate(targets)]
+    # Embedding pertanyaan di-cache dulu agar yang diukur hanya retrieval
+    for question, _ in questions:
+        await rag.embed_query(question)
+
+    results = {'chunks': args.chunks, 'lexical_build_seconds': None}
+    if rag.VECTOR_STORE == 'local':
+        # Di jalur pertanyaan indeks dibangun di latar belakang; di sini ditunggu dulu
+        start = time.perf_counter()
+        await rag.lexical_indexes.get('1')
+        results['lexical_build_seconds'] = time.perf_counter() - start
+    for name, hybrid in (('vector', False), ('hybrid', True)):
+        identifier_questions = questions[0::2]
+        results[name] = await run_mode(rag, hybrid, questions)
+        results[name]['identifier_hit_rate'] = (await run_mode(rag, hybrid, identifier_questions))['hit_rate']
+    # Biaya lokal tambahan jalur hibrida (di luar RPC yang berjalan bersamaan)
+    results['stages'] = {stage: rag.metrics.summary(stage)[stage] for stage in ('lexical.search', 'hybrid.fuse')}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=5000)
+    parser.add_argument('--words', type=int, default=150, help="Kata per potongan")
+    parser.add_argument('--questions', type=int, default=200)
+    parser.add_argument('--db-latency', type=float, default=0.02, help="Latensi per panggilan Supabase palsu (detik)")
+    parser.add_argument('--store', choices=['supabase', 'local'], default='supabase')
+    parser.add_argument('--json', help="Tulis hasil lengkap ke file JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ.update({'VECTOR_STORE': args.store, 'LOCAL_STORE_DIR': os.path.join(workdir, 'vector_store'),
+                           'HISTORY_DIR': os.path.join(workdir, 'chat_history'), 'CAPTION_CACHE_PATH': ''})
+        import rag
+        result = asyncio.run(run(rag, args))
+
+    build = result['lexical_build_seconds']
+    print(f"Potongan: {result['chunks']}" + (f", bangun indeks BM25: {build * 1000:.0f} ms" if build is not None else ""))
+    print(f"{'mode':<8}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'kandidat':>10}{'hit':>8}{'hit id':>8}")
+    for name in ('vector', 'hybrid'):
+        stats = result[name]
+        print(f"{name:<8}{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}"
+              f"{stats['avg_candidates']:>10.1f}{stats['hit_rate']:>8.2f}{stats['identifier_hit_rate']:>8.2f}")
+    overhead = (result['hybrid']['p50'] - result['vector']['p50']) * 1000
+    print(f"Tambahan latensi hibrida (p50): {overhead:+.1f} ms")
+    for stage, stats in result['stages'].items():
+        print(f"  {stage:<16} p50 {stats['p50'] * 1000:.2f} ms, p95 {stats['p95'] * 1000:.2f} ms")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+    main()
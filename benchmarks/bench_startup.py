@@ -0,0 +1,106 @@
+# ===================================================================================
+# BENCHMARK COLD START: WAKTU SAMPAI RESPONS PERTAMA SETELAH PROSES MULAI
+# Setiap percobaan menjalankan interpreter baru yang mengimpor rag.py, lalu
+# menangani update pertama (unggah TXT kecil) dan pertanyaan pertama dengan
+# pengganti lokal dari benchmarks/fakes.py. Respons pertama dihitung dari
+# rag.PROCESS_START sampai FakeBot.send_message pertama selesai.
+# Dengan --warm-up, rag.warm_up() dijalankan dulu (seperti setelah bot start),
+# sehingga terlihat biaya yang dipindahkan dari pengguna pertama ke warm-up.
+#
+#   python benchmarks/bench_startup.py --runs 5
+# ===================================================================================
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+def child(args):
+    """Satu percobaan di proses baru; hasil dicetak sebagai satu baris JSON."""
+    workdir = tempfile.mkdtemp()
+    os.environ.update({
+        'VECTOR_STORE': 'local', 'LOCAL_STORE_DIR': os.path.join(workdir, 'vector_store'),
+        'HISTORY_DIR': os.path.join(workdir, 'chat_history'), 'CAPTION_CACHE_PATH': '',
+    })
+    os.chdir(workdir)
+    import rag
+    imported = time.monotonic() - rag.PROCESS_START
+    from fakes import FakeApplication, FakeBot, FakeEmbedder, FakeModel, echo_question
+
+    async def run() -> dict:
+        rag.genai = types.SimpleNamespace(embed_content=FakeEmbedder(args.embed_latency), get_model=lambda name: None)
+        rag.refine_model = FakeModel('flash', args.flash_latency, respond=echo_question)
+        rag.generative_model = FakeModel('pro', args.pro_latency)
+        bot = FakeBot()
+        app = FakeApplication(bot)
+        rag.register_handlers(app)
+        result = {'import': imported}
+        if args.warm_up:
+            start = time.monotonic()
+            await rag.warm_up()
+            result['warm_up'] = time.monotonic() - start
+        source = os.path.join(workdir, 'catatan.txt')
+        with open(source, 'w', encoding='utf-8') as f:
+            f.write("Nomor faktur INV-2024-0042 dibayar pada bulan Maret untuk proyek logistik.\n\n" * 20)
+
+        start = time.monotonic()
+        update, context = app.upload(1, source, 'catatan.txt')
+        await rag.handle_document(update, context)
+        await context.user_data['processing_task']
+        ingest = time.monotonic() - start
+        # Respons pertama = balasan bot pertama yang benar-benar terkirim ke pengguna
+        # (pesan status dari antrean ingest), bukan saat handler selesai mengantre
+        result['first_response'] = bot.first_reply_at - rag.PROCESS_START
+        result['first_ingest'] = ingest
+
+        start = time.monotonic()
+        update, context = app.make_update(1, text="Kapan faktur INV-2024-0042 dibayar untuk proyek logistik?")
+        await rag.handle_message(update, context)
+        result['first_answer'] = time.monotonic() - start
+        return result
+
+    try:
+        result = asyncio.run(run())
+    finally:
+        if rag._process_pool is not None:
+            rag._process_pool.shutdown()
+    print(json.dumps(result))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--warm-up', action='store_true', help="Jalankan rag.warm_up() sebelum update pertama")
+    parser.add_argument('--embed-latency', type=float, default=0.05)
+    parser.add_argument('--flash-latency', type=float, default=0.3)
+    parser.add_argument('--pro-latency', type=float, default=1.0)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+
+    command = [sys.executable, os.path.abspath(__file__), '--child'] + sys.argv[1:]
+    runs = []
+    for _ in range(args.runs):
+        start = time.monotonic()
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result['process'] = time.monotonic() - start
+        runs.append(result)
+
+    print(f"{'tahap':<16}{'min (ms)':>10}{'median (ms)':>13}{'maks (ms)':>11}")
+    for stage in runs[0]:
+        values = sorted(run[stage] for run in runs)
+        print(f"{stage:<16}{values[0] * 1000:>10.0f}{values[len(values) // 2] * 1000:>13.0f}{values[-1] * 1000:>11.0f}")
+    print("first_response = dari rag.PROCESS_START sampai balasan bot pertama terkirim;"
+          " process = durasi seluruh subprocess (termasuk start interpreter)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+# ===================================================================================
+# PENGGANTI LOKAL UNTUK TELEGRAM, GEMINI, DAN SUPABASE (UNTUK BENCHMARK)
+# Semua pengganti deterministik dan tidak membutuhkan jaringan maupun API key:
+# - FakeSupabase: tabel `documents`/`document_catalog` di memori beserta RPC
+#   match_documents dan match_documents_by_file (kemiripan kosinus NumPy), serta
+#   match_documents_text (full-text search, ditiru dengan lexical.BM25Index).
+# - FakeModel / FakeEmbedder: model generasi dan embedding dengan latensi buatan.
+# - FakeApplication / FakeBot / FakeMessage: cukup untuk menjalankan handler rag.py.
+# ===================================================================================
+import asyncio
+import hashlib
+import re
+import shutil
+import threading
+import time
+import types
+
+import numpy as np
+
+import lexical
+
+EMBEDDING_DIM = 768
+
+# --- Supabase ---
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+class FakeQuery:
+    """Query builder postgrest minimal: select/insert/upsert/update/delete + eq/in_/order/range/limit."""
+    def __init__(self, client, table: str):
+        self.client = client
+        self.table = table
+        self.op = None
+        self.payload = None
+        self.columns = None
+        self.count = None
+        self.on_conflict = None
+        self.filters = []
+        self.order_by = None
+        self.bounds = None
+
+    def select(self, columns: str = '*', count: str = None):
+        self.op, self.columns, self.count = 'select', columns, count
+        return self
+
+    def insert(self, rows):
+        self.op, self.payload = 'insert', rows
+        return self
+
+    def upsert(self, rows, on_conflict: str = ''):
+        self.op, self.payload, self.on_conflict = 'upsert', rows, on_conflict
+        return self
+
+    def update(self, values: dict):
+        self.op, self.payload = 'update', values
+        return self
+
+    def delete(self, count: str = None):
+        self.op, self.count = 'delete', count
+        return self
+
+    def eq(self, column: str, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column: str, values):
+        value_set = set(values)
+        self.filters.append(lambda row: row.get(column) in value_set)
+        return self
+
+    def order(self, column: str, desc: bool = False):
+        self.order_by = (column, desc)
+        return self
+
+    def range(self, start: int, end: int):
+        self.bounds = (start, end + 1)
+        return self
+
+    def limit(self, n: int):
+        self.bounds = (0, n)
+        return self
+
+    def _project(self, row: dict) -> dict:
+        if self.columns in (None, '*'):
+            return {k: v for k, v in row.items() if k != 'embedding'}
+        return {c.strip(): row.get(c.strip()) for c in self.columns.split(',')}
+
+    def execute(self):
+        self.client.calls += 1
+        time.sleep(self.client.latency)
+        with self.client.lock:
+            rows = self.client.tables.setdefault(self.table, [])
+            if self.op != 'select':
+                self.client.version += 1
+            if self.op == 'insert':
+                for row in self.payload if isinstance(self.payload, list) else [self.payload]:
+                    self.client.next_id += 1
+                    rows.append({'id': self.client.next_id, **row})
+                return FakeResponse([])
+            if self.op == 'upsert':
+                keys = [k.strip() for k in self.on_conflict.split(',') if k.strip()]
+                for row in self.payload if isinstance(self.payload, list) else [self.payload]:
+                    existing = next((r for r in rows if keys and all(r.get(k) == row.get(k) for k in keys)), None)
+                    if existing is not None:
+                        existing.update(row)
+                    else:
+                        rows.append(dict(row))
+                return FakeResponse([])
+            matched = [row for row in rows if all(f(row) for f in self.filters)]
+            if self.op == 'update':
+                for row in matched:
+                    row.update(self.payload)
+                return FakeResponse([])
+            if self.op == 'delete':
+                self.client.tables[self.table] = [row for row in rows if not all(f(row) for f in self.filters)]
+                return FakeResponse([], len(matched))
+            if self.order_by:
+                column, desc = self.order_by
+                matched.sort(key=lambda row: row.get(column), reverse=desc)
+            if self.bounds:
+                matched = matched[self.bounds[0]:self.bounds[1]]
+            return FakeResponse([self._project(row) for row in matched], len(matched) if self.count else None)
+
+class FakeRpc:
+    def __init__(self, client, name: str, params: dict):
+        self.client, self.name, self.params = client, name, params
+
+    def execute(self):
+        self.client.calls += 1
+        time.sleep(self.client.latency)
+        params = self.params
+        if self.name == 'match_documents_text':
+            return self._text_search(params)
+        if self.name not in ('match_documents', 'match_documents_by_file'):
+            raise ValueError(f"RPC tidak dikenal: {self.name}")
+        with self.client.lock:
+            rows = [row for row in self.client.tables.get('documents', [])
+                    if row['user_id'] == params['user_id_input']
+                    and (self.name == 'match_documents' or row['file_name'] == params['file_name_input'])]
+        if not rows:
+            return FakeResponse([])
+        matrix = np.asarray([row['embedding'] for row in rows], dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-9
+        query = np.asarray(params['query_embedding'], dtype=np.float32)
+        query /= np.linalg.norm(query) + 1e-9
+        scores = matrix @ query
+        order = [i for i in np.argsort(-scores) if scores[i] >= params['match_threshold']][:params['match_count']]
+        return FakeResponse([{'id': rows[i]['id'], 'content': rows[i]['content'], 'file_name': rows[i]['file_name'],
+                              'page_number': rows[i]['page_number'], 'similarity': float(scores[i])} for i in order])
+
+    def _text_search(self, params: dict) -> FakeResponse:
+        # Indeks BM25 per pengguna dibangun ulang hanya jika tabel berubah
+        user_id = params['user_id_input']
+        with self.client.lock:
+            cached = self.client.text_indexes.get(user_id)
+            if cached is None or cached[0] != self.client.version:
+                index = lexical.BM25Index()
+                for row in self.client.tables.get('documents', []):
+                    if row['user_id'] == user_id:
+                        index.add(row['content'], row['file_name'], row['page_number'], row.get('content_hash'))
+                cached = self.client.text_indexes[user_id] = (self.client.version, index)
+        hits = cached[1].search(" ".join(params['query_terms']), params['match_count'],
+                                params.get('file_name_input'), params['min_idf'])
+        return FakeResponse([{'content': doc['content'], 'file_name': doc['file_name'],
+                              'page_number': doc['page_number'], 'rank': score} for score, doc in hits])
+
+class FakeSupabase:
+    """Klien Supabase di memori (table + rpc) dengan latensi per permintaan."""
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.tables = {}
+        self.next_id = 0
+        self.calls = 0
+        self.version = 0
+        self.text_indexes = {}
+        self.lock = threading.Lock()
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: dict) -> FakeRpc:
+        return FakeRpc(self, name, params)
+
+# --- Gemini ---
+def fake_vector(text: str) -> list:
+    """Vektor deterministik dari kata-kata teks (bag of hashed words), sehingga teks
+    yang berbagi kata juga berdekatan secara kosinus."""
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for word in re.findall(r'\w+', text.lower()):
+        digest = hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest()
+        vector[int.from_bytes(digest[:4], 'little') % EMBEDDING_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+class FakeEmbedder:
+    """Pengganti genai.embed_content: latency per panggilan + per_item per teks."""
+    def __init__(self, latency: float = 0.05, per_item: float = 0.0):
+        self.latency = latency
+        self.per_item = per_item
+        self.calls = 0
+        self.items = 0
+
+    def __call__(self, model, content, task_type=None, **kwargs):
+        texts = content if isinstance(content, list) else [content]
+        self.calls += 1
+        self.items += len(texts)
+        time.sleep(self.latency + self.per_item * len(texts))
+        vectors = [fake_vector(text) for text in texts]
+        return {'embedding': vectors if isinstance(content, list) else vectors[0]}
+
+def echo_question(contents) -> str:
+    """Jawaban refine: kembalikan pertanyaan asli dari prompt refine_question."""
+    match = re.search(r'Pertanyaan Asli: "(.*)"', str(contents), re.S)
+    return match.group(1) if match else str(contents)[-200:]
+
+class FakeResult:
+    def __init__(self, text: str):
+        self.text = text
+        self.parts = [text] if text else []
+
+class FakeModel:
+    """Pengganti GenerativeModel: jawaban deterministik setelah `latency` detik.
+    Dengan stream=True, jawaban dikirim per potongan dalam rentang waktu yang sama.
+    `respond(contents) -> str` dapat menggantikan jawaban bawaan."""
+    def __init__(self, name: str, latency: float = 0.5, answer_words: int = 120, stream_chunks: int = 8, respond=None):
+        self.model_name = name
+        self.respond = respond
+        self.latency = latency
+        self.answer_words = answer_words
+        self.stream_chunks = stream_chunks
+        self.calls = 0
+
+    def _answer(self, contents) -> str:
+        if self.respond:
+            return self.respond(contents)
+        seed = hashlib.sha1(repr(contents).encode('utf-8')).hexdigest()[:8]
+        return f"Jawaban {self.model_name} {seed}: " + " ".join(
+            f"poin{i}" for i in range(self.answer_words))
+
+    def generate_content(self, contents, stream: bool = False, **kwargs):
+        self.calls += 1
+        text = self._answer(contents)
+        if not stream:
+            time.sleep(self.latency)
+            return FakeResult(text)
+        return self._stream(text)
+
+    def _stream(self, text: str):
+        step = max(1, len(text) // self.stream_chunks)
+        for i in range(0, len(text), step):
+            time.sleep(self.latency / self.stream_chunks)
+            yield FakeResult(text[i:i + step])
+
+# --- Telegram ---
+class FakeMessage:
+    _next_id = 0
+    _id_lock = threading.Lock()
+
+    def __init__(self, bot, chat_id: int, text: str = None, document=None):
+        with FakeMessage._id_lock:
+            FakeMessage._next_id += 1
+            self.message_id = FakeMessage._next_id
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.document = document
+        self.from_user = types.SimpleNamespace(id=chat_id)
+
+    async def reply_text(self, text: str, **kwargs):
+        return await self.bot.send_message(self.chat_id, text, **kwargs)
+
+    async def edit_text(self, text: str, **kwargs):
+        await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+        self.text = text
+        return self
+
+    async def delete(self):
+        await self.bot.delete_message(self.chat_id, self.message_id)
+
+class FakeFile:
+    def __init__(self, source: str):
+        self.source = source
+
+    async def download_to_drive(self, path: str):
+        await asyncio.to_thread(shutil.copyfile, self.source, path)
+
+class FakeBot:
+    """Mencatat setiap panggilan API bot; file_id dipetakan ke file sumber lokal."""
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.files = {}
+        self.sent = []
+        self.counts = {}
+        self.first_reply_at = None  # time.monotonic() saat send_message pertama selesai
+
+    async def _call(self, method: str, payload=None):
+        self.counts[method] = self.counts.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if payload is not None:
+            self.sent.append((method, payload))
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self._call('send_message', (chat_id, text))
+        if self.first_reply_at is None:
+            self.first_reply_at = time.monotonic()
+        return FakeMessage(self, chat_id, text)
+
+    async def edit_message_text(self, text: str = None, chat_id: int = None, message_id: int = None, **kwargs):
+        await self._call('edit_message_text')
+
+    async def delete_message(self, chat_id: int, message_id: int):
+        await self._call('delete_message')
+
+    async def send_document(self, chat_id: int, document, **kwargs):
+        await self._call('send_document', (chat_id, len(document.getvalue()) if hasattr(document, 'getvalue') else None))
+
+    async def get_file(self, file_id: str):
+        await self._call('get_file')
+        return FakeFile(self.files[file_id])
+
+class FakeApplication:
+    """Pengganti telegram.ext.Application: menyimpan handler (lewat add_handler) dan
+    user_data per pengguna, lalu membuat update/context sintetis untuk handler."""
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
+        self.handlers = []
+        self.user_data = {}
+
+    def add_handler(self, handler, group: int = 0):
+        self.handlers.append(handler)
+
+    def command(self, name: str):
+        for handler in self.handlers:
+            if name in getattr(handler, 'commands', ()):
+                return handler.callback
+        raise KeyError(f"Perintah /{name} tidak terdaftar")
+
+    def make_update(self, user_id: int, text: str = None, document=None, args: list = None):
+        message = FakeMessage(self.bot, user_id, text, document)
+        update = types.SimpleNamespace(message=message, effective_chat=types.SimpleNamespace(id=user_id),
+                                       effective_user=message.from_user)
+        context = types.SimpleNamespace(bot=self.bot, application=self, args=args or [],
+                                        user_data=self.user_data.setdefault(user_id, {}))
+        return update, context
+
+    def upload(self, user_id: int, source: str, file_name: str):
+        file_id = f"u{user_id}_{len(self.bot.files)}"
+        self.bot.files[file_id] = source
+        return self.make_update(user_id, document=types.SimpleNamespace(file_id=file_id, file_name=file_name))
@@ -0,0 +1,86 @@
+# ===================================================================================
+# EKSTRAKSI DAN CHUNKING DOKUMEN (CPU-BOUND)
+# Fungsi di modul ini dijalankan di process pool oleh rag.py agar parsing PDF/DOCX
+# dan pemotongan teks tidak menahan event loop bot. Modul ini sengaja hanya
+# bergantung pada PyMuPDF, python-docx, dan langchain supaya proses worker ringan.
+# Ketiganya baru diimpor saat pertama dipakai, sehingga `import extraction` (dan
+# start bot) tetap cepat.
+# ===================================================================================
+import hashlib
+import os
+
+CHUNK_SIZE = 1500
+CHUNK_OVERLAP = 300
+
+# Text splitter dibuat sekali per proses saat pertama dibutuhkan
+_text_splitter = None
+
+def get_text_splitter():
+    global _text_splitter
+    if _text_splitter is None:
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        _text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
+            length_function=len,
+        )
+    return _text_splitter
+
+def warm_up() -> int:
+    """Memuat pustaka ekstraksi di proses worker lebih awal (dipanggil saat bot start)."""
+    import fitz  # noqa: F401
+    import docx  # noqa: F401
+    get_text_splitter()
+    return os.getpid()
+
+def pdf_page_count(pdf_path: str) -> int:
+    import fitz  # PyMuPDF
+    with fitz.open(pdf_path) as doc:
+        return len(doc)
+
+def extract_pdf_pages(pdf_path: str, start: int, end: int, min_image_bytes: int, min_image_side: int) -> list:
+    """
+    Mengekstrak halaman [start, end) sebuah PDF. Setiap halaman menjadi
+    {'page': nomor, 'chunks': [teks, ...], 'images': [(hash, bytes), ...]}.
+    Gambar kecil/dekoratif dilewati dan gambar yang sama hanya dikembalikan
+    sekali per rentang (deduplikasi lintas rentang dilakukan oleh pemanggil).
+    """
+    import fitz  # PyMuPDF
+    text_splitter = get_text_splitter()
+    pages = []
+    seen_images = set()
+    with fitz.open(pdf_path) as doc:
+        for i in range(start, min(end, len(doc))):
+            page = doc[i]
+            page_number = i + 1
+            text = page.get_text("text")
+            images = []
+            for img_info in page.get_images(full=True):
+                try:
+                    base_image = doc.extract_image(img_info[0])
+                    image_bytes = base_image["image"]
+                    # Lewati gambar kecil/dekoratif (ikon, garis, bullet)
+                    if len(image_bytes) < min_image_bytes or min(base_image.get("width", 0), base_image.get("height", 0)) < min_image_side:
+                        continue
+                    image_hash = hashlib.sha256(image_bytes).hexdigest()
+                    if image_hash in seen_images:
+                        continue
+                    seen_images.add(image_hash)
+                    images.append((image_hash, image_bytes))
+                except Exception as e: print(f"Gagal ekstrak gambar di hal {page_number}: {e}")
+            pages.append({'page': page_number, 'chunks': text_splitter.split_text(text) if text else [], 'images': images})
+    return pages
+
+def extract_text_chunks(file_path: str, file_extension: str) -> list:
+    """Membaca DOCX/TXT dan memotongnya menjadi potongan teks."""
+    full_text = ""
+    if file_extension == 'docx':
+        import docx  # python-docx
+        document = docx.Document(file_path)
+        full_text = "\n".join([para.text for para in document.paragraphs])
+    elif file_extension == 'txt':
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            full_text = f.read()
+    if not full_text.strip():
+        return []
+    return get_text_splitter().split_text(full_text)
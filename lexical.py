@@ -0,0 +1,128 @@
+# ===================================================================================
+# INDEKS LEKSIKAL BM25 (FULL-TEXT) UNTUK RETRIEVAL HIBRIDA
+# Dipakai rag.py berdampingan dengan pencarian vektor: embedding sering meleset
+# untuk pencocokan persis (nomor faktur, kode pasal, nama), sedangkan BM25 justru
+# kuat di situ. Indeks disimpan di memori per pengguna dan diperbarui inkremental
+# (tambah/hapus potongan) tanpa membangun ulang. Modul ini murni Python.
+# ===================================================================================
+import heapq
+import math
+import re
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Token = kata atau pengenal yang dihubungkan '-', '/', '.', atau '_' (mis. INV-2024-0042,
+# 3.2.1, PT/ABC/01). Pengenal juga dipecah per bagian agar pencarian sebagian tetap cocok.
+_TOKEN_RE = re.compile(r"\w+(?:[-/._]\w+)*")
+
+# Kata fungsi (Indonesia + Inggris) diabaikan di query: kecocokan pada kata seperti
+# "yang" atau "dan" bukan bukti relevansi
+STOPWORDS = frozenset("""
+yang dan di ke dari untuk dengan pada adalah ini itu dalam atau juga tidak ada akan oleh
+sebagai bisa dapat karena saya aku apa siapa bagaimana berapa kapan mengapa kenapa dimana
+mana apakah tersebut para telah sudah belum lebih secara antara hal jika kalau maka agar
+serta namun tetapi tapi hanya sangat setiap kami kita mereka anda ia dia nya pun lah kah
+the a an of and or to in on for is are was were be what who how when which why this that
+""".split())
+
+def is_identifier(token: str) -> bool:
+    """Token berangka atau bersambung ('-', '/', '.', '_'), mis. INV-2024-0042 atau 3.2.1."""
+    return not token.isalpha()
+
+def tokenize(text: str) -> list:
+    tokens = []
+    for match in _TOKEN_RE.finditer(text.casefold()):
+        token = match.group()
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(part for part in re.split(r"[-/._]", token) if part)
+    return tokens
+
+class BM25Index:
+    """
+    Indeks BM25 inkremental. Setiap dokumen (potongan) diberi id internal dan
+    dikelompokkan per kunci (nama file, content_hash) sehingga baris yang dihapus
+    di database bisa dihapus juga di sini tanpa id database. Potongan kembar
+    dengan kunci sama disimpan sebagai dokumen terpisah.
+    """
+    def __init__(self):
+        self.docs = {}        # id -> {'content', 'file_name', 'page_number', 'length', 'terms'}
+        self.postings = {}    # term -> {id: frekuensi}
+        self.keys = {}        # (file_name, content_hash) -> [id, ...]
+        self.total_length = 0
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, content: str, file_name: str, page_number: int, content_hash: str):
+        doc_id = self.next_id
+        self.next_id += 1
+        terms = {}
+        for token in tokenize(content):
+            terms[token] = terms.get(token, 0) + 1
+        for term, freq in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = freq
+        length = sum(terms.values())
+        self.docs[doc_id] = {'content': content, 'file_name': file_name, 'page_number': page_number,
+                             'length': length, 'terms': tuple(terms)}
+        self.keys.setdefault((file_name, content_hash), []).append(doc_id)
+        self.total_length += length
+
+    def _remove_doc(self, doc_id: int):
+        doc = self.docs.pop(doc_id)
+        for term in doc['terms']:
+            posting = self.postings[term]
+            del posting[doc_id]
+            if not posting:
+                del self.postings[term]
+        self.total_length -= doc['length']
+
+    def remove(self, file_name: str, content_hash: str) -> bool:
+        """Menghapus satu dokumen dengan kunci ini; False jika tidak ada."""
+        ids = self.keys.get((file_name, content_hash))
+        if not ids:
+            return False
+        self._remove_doc(ids.pop())
+        if not ids:
+            del self.keys[(file_name, content_hash)]
+        return True
+
+    def remove_file(self, file_name: str) -> int:
+        keys = [key for key in self.keys if key[0] == file_name]
+        removed = 0
+        for key in keys:
+            for doc_id in self.keys.pop(key):
+                self._remove_doc(doc_id)
+                removed += 1
+        return removed
+
+    def search(self, query: str, limit: int, file_name: str = None, min_idf: float = 0.0) -> list:
+        """
+        Top-`limit` dokumen menurut skor BM25: [(skor, dokumen), ...] urut menurun.
+        Stopword di query diabaikan, dan hanya dokumen yang cocok dengan minimal satu
+        pengenal atau istilah langka (idf >= min_idf) yang dikembalikan; kata umum
+        tetap menambah skor dokumen tersebut.
+        """
+        if not self.docs or limit <= 0:
+            return []
+        n = len(self.docs)
+        avg_length = self.total_length / n or 1.0
+        scores = {}
+        anchored = set()
+        for term in set(tokenize(query)) - STOPWORDS:
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            if idf >= min_idf or is_identifier(term):
+                anchored.update(posting)
+            for doc_id, freq in posting.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.docs[doc_id]['length'] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * freq * (BM25_K1 + 1) / (freq + norm)
+        scores = {doc_id: score for doc_id, score in scores.items() if doc_id in anchored}
+        if file_name:
+            scores = {doc_id: score for doc_id, score in scores.items() if self.docs[doc_id]['file_name'] == file_name}
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(score, self.docs[doc_id]) for doc_id, score in best]
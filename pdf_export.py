@@ -0,0 +1,136 @@
+# ===================================================================================
+# EKSPOR RIWAYAT PERCAKAPAN KE PDF (CPU-BOUND)
+# Dijalankan di process pool oleh rag.py. Lebar glyph per font di-cache sekali per
+# proses sehingga pemotongan baris cukup satu kali lintasan per teks, dan hasil
+# PDF dikembalikan sebagai bytes (tanpa file sementara).
+# ===================================================================================
+import os
+from fpdf import FPDF
+from fpdf.enums import XPos, YPos
+
+# Lokasi umum font DejaVu (Unicode) di Linux: (reguler, tebal)
+FONT_CANDIDATES = [
+    ('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf'),
+    ('/usr/share/fonts/dejavu-sans-fonts/DejaVuSans.ttf', '/usr/share/fonts/dejavu-sans-fonts/DejaVuSans-Bold.ttf'),
+    ('/usr/share/fonts/TTF/DejaVuSans.ttf', '/usr/share/fonts/TTF/DejaVuSans-Bold.ttf'),
+    ('/usr/share/fonts/dejavu/DejaVuSans.ttf', '/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf'),
+]
+
+TITLE = "Riwayat Percakapan Chatbot"
+FONT_SIZE = 11
+LINE_HEIGHT = 7
+
+# {(font, gaya): {karakter: lebar per satuan ukuran font}}, diisi bertahap per proses
+_width_tables = {}
+
+def find_unicode_font(font_path: str = None, bold_font_path: str = None) -> tuple:
+    """
+    Mengembalikan (reguler, tebal) font TTF yang tersedia. Jika hanya font reguler
+    yang ada, versi tebal memakai font yang sama; (None, None) berarti tidak ada
+    font Unicode dan ekspor kembali ke Helvetica (latin-1).
+    """
+    if font_path:
+        if not os.path.exists(font_path):
+            raise FileNotFoundError(f"Font ekspor tidak ditemukan: {font_path}")
+        return font_path, bold_font_path if bold_font_path and os.path.exists(bold_font_path) else font_path
+    for regular, bold in FONT_CANDIDATES:
+        if os.path.exists(regular):
+            return regular, bold if os.path.exists(bold) else regular
+    return None, None
+
+class GlyphWidths:
+    """Pengukur lebar teks untuk font aktif dengan tabel lebar per karakter yang di-cache."""
+    def __init__(self, pdf: FPDF, key: tuple):
+        self.pdf = pdf
+        self.size = pdf.font_size
+        self.table = _width_tables.setdefault(key, {})
+
+    def char(self, c: str) -> float:
+        ratio = self.table.get(c)
+        if ratio is None:
+            ratio = self.table[c] = self.pdf.get_string_width(c) / self.pdf.font_size
+        return ratio * self.size
+
+    def measure(self, text: str) -> float:
+        table = self.table
+        total = 0.0
+        for c in text:
+            ratio = table.get(c)
+            if ratio is None:
+                ratio = self.char(c) / self.size
+            total += ratio
+        return total * self.size
+
+def wrap_text(text: str, widths: GlyphWidths, max_width: float) -> list:
+    """
+    Memotong teks menjadi baris selebar maksimal max_width dalam satu lintasan:
+    lebar baris dijumlahkan per kata, bukan diukur ulang setiap kata ditambahkan.
+    Kata yang lebih panjang dari satu baris dipotong per karakter. Baris baru di
+    teks asli dipertahankan.
+    """
+    lines = []
+    space = widths.char(' ')
+    for paragraph in text.split('\n'):
+        line, line_width = [], 0.0
+        for word in paragraph.split():
+            word_width = widths.measure(word)
+            if word_width > max_width:
+                # Kata lebih lebar dari satu baris: tutup baris berjalan lalu potong per karakter
+                if line:
+                    lines.append(' '.join(line))
+                piece, piece_width = [], 0.0
+                for c in word:
+                    w = widths.char(c)
+                    if piece and piece_width + w > max_width:
+                        lines.append(''.join(piece))
+                        piece, piece_width = [], 0.0
+                    piece.append(c)
+                    piece_width += w
+                line, line_width = [''.join(piece)], piece_width
+            elif line and line_width + space + word_width > max_width:
+                lines.append(' '.join(line))
+                line, line_width = [word], word_width
+            else:
+                line_width += (space if line else 0.0) + word_width
+                line.append(word)
+        lines.append(' '.join(line))
+    return lines
+
+def build_history_pdf(history: list, font_path: str = None, bold_font_path: str = None) -> bytes:
+    """Membuat PDF dari [{'question': ..., 'answer': ...}, ...] dan mengembalikan isinya."""
+    regular, bold = find_unicode_font(font_path, bold_font_path)
+    pdf = FPDF()
+    if regular:
+        pdf.add_font('Export', '', regular)
+        pdf.add_font('Export', 'B', bold)
+        family, key_base = 'Export', (regular, bold)
+        clean = lambda text: text
+    else:
+        family, key_base = 'Helvetica', ('Helvetica',)
+        clean = lambda text: text.encode('latin-1', 'replace').decode('latin-1')
+    pdf.add_page()
+    available_width = pdf.w - pdf.l_margin - pdf.r_margin
+
+    def write(text: str, style: str):
+        pdf.set_font(family, style, FONT_SIZE)
+        widths = GlyphWidths(pdf, key_base + (style,))
+        # Baris sudah dipotong sendiri, jadi cukup pdf.text() per baris (jauh lebih
+        # murah daripada cell()) dengan pindah halaman manual. Posisi baseline sama
+        # seperti teks di tengah cell setinggi LINE_HEIGHT.
+        x = pdf.l_margin + pdf.c_margin
+        baseline = LINE_HEIGHT / 2 + 0.3 * pdf.font_size
+        for line in wrap_text(clean(text), widths, available_width - 2 * pdf.c_margin):
+            if pdf.y + LINE_HEIGHT > pdf.page_break_trigger:
+                pdf.add_page()
+            if line:
+                pdf.text(x, pdf.y + baseline, line)
+            pdf.y += LINE_HEIGHT
+
+    pdf.set_font(family, 'B', 12)
+    pdf.cell(0, 10, text=TITLE, align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.ln(5)
+    for item in history:
+        write(f"Anda: {item['question']}", 'B')
+        write(f"Bot: {item['answer']}", '')
+        pdf.ln(5)  # Spasi antar entri chat
+    return bytes(pdf.output())
@@ -3,24 +3,43 @@
 # ===================================================================================
 
 # 1. IMPORT PUSTAKA
+# Pustaka berat (google.generativeai, supabase, PyMuPDF, python-docx, langchain,
+# fpdf, PIL) baru diimpor saat pertama dipakai atau oleh warm_up() setelah bot
+# start, sehingga proses baru (dan worker process pool) cepat siap.
+import time
+PROCESS_START = time.monotonic()  # Acuan waktu start dan respons pertama
+
 import os
 import asyncio
+import bisect
+import contextlib
+import contextvars
+import heapq
+import itertools
+import functools
 import io
 import html
-import fitz  # PyMuPDF
-import docx  # python-docx
-import time
-from PIL import Image
-from fpdf import FPDF
-import google.generativeai as genai
-from supabase import create_client, Client
+import hashlib
+import json
+import math
+import random
+import tempfile
+from datetime import datetime, timezone
+import threading
+import numpy as np
+import httpx
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
 import nest_asyncio
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from dotenv import load_dotenv
-from fpdf.enums import XPos, YPos
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import extraction
+import lexical
 
 nest_asyncio.apply()
 
@@ -33,129 +52,2329 @@ GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 
-if not all([TELEGRAM_BOT_TOKEN, GEMINI_API_KEY, SUPABASE_URL, SUPABASE_KEY]):
-    raise ValueError("Satu atau lebih environment variable (API key) tidak ditemukan.")
+# Backend penyimpanan vektor: 'supabase' (default) atau 'local' (tanpa Supabase)
+VECTOR_STORE = os.getenv('VECTOR_STORE', 'supabase').lower()
+LOCAL_STORE_DIR = os.getenv('LOCAL_STORE_DIR', 'vector_store')
+
+def check_config():
+    """Memastikan kredensial tersedia. Dipanggil saat bot dijalankan, bukan saat modul
+    diimpor, agar rag.py bisa diimpor tanpa API key (mis. oleh benchmark)."""
+    if not all([TELEGRAM_BOT_TOKEN, GEMINI_API_KEY]) or (VECTOR_STORE == 'supabase' and not all([SUPABASE_URL, SUPABASE_KEY])):
+        raise ValueError("Satu atau lebih environment variable (API key) tidak ditemukan.")
+
+# Klien Gemini dan Supabase dibuat saat pertama dipakai (lihat get_genai/get_supabase).
+# Keduanya hanya dipanggil dari thread pool (run_blocking/db_execute): impor pertama
+# memakan ratusan milidetik dan _client_lock tidak boleh ditunggu di event loop.
+genai = None
+supabase = None
+_client_lock = threading.Lock()
+
+def get_genai():
+    """Modul google.generativeai yang sudah dikonfigurasi (diimpor saat pertama dipanggil)."""
+    global genai
+    if genai is None:
+        with _client_lock:
+            if genai is None:
+                import google.generativeai as module
+                module.configure(api_key=GEMINI_API_KEY)
+                genai = module
+    return genai
+
+def get_supabase():
+    global supabase
+    if supabase is None:
+        with _client_lock:
+            if supabase is None:
+                from supabase import create_client
+                supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return supabase
 
-genai.configure(api_key=GEMINI_API_KEY)
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+class LazyModel:
+    """GenerativeModel yang baru dibuat saat atributnya (mis. generate_content) pertama diakses."""
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self._model = None
+
+    def __getattr__(self, name):
+        if self._model is None:
+            self._model = get_genai().GenerativeModel(self.model_name)
+        return getattr(self._model, name)
+
+# Mode server: polling (default) atau webhook jika WEBHOOK_URL (URL publik bot, mis.
+# domain Railway) diatur. Webhook mendengarkan di WEBHOOK_LISTEN:PORT/WEBHOOK_PATH;
+# WEBHOOK_SECRET (opsional) diperiksa di header setiap update dari Telegram.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+# Setelah start, impor pustaka berat, siapkan process pool, dan buka koneksi ke
+# Gemini/Supabase di latar belakang agar pengguna pertama tidak menanggungnya
+WARM_UP = os.getenv('WARM_UP', 'true').lower() in ('1', 'true', 'yes')
+
+# Jalur pertanyaan cepat: lewati refine untuk pertanyaan yang sudah jelas, refine
+# dengan model ringan, dan jalankan pencarian spekulatif paralel dengan refine
+FAST_QUERY_PATH = os.getenv('FAST_QUERY_PATH', 'true').lower() in ('1', 'true', 'yes')
+SPECULATIVE_RETRIEVAL = os.getenv('SPECULATIVE_RETRIEVAL', 'true').lower() in ('1', 'true', 'yes')
+REFINE_MODEL_NAME = os.getenv('REFINE_MODEL', 'gemini-2.5-flash')
+REFINE_MIN_WORDS = int(os.getenv('REFINE_MIN_WORDS', '4'))
+REFINE_SIMILARITY_THRESHOLD = float(os.getenv('REFINE_SIMILARITY_THRESHOLD', '0.6'))
+TIMING_WINDOW = int(os.getenv('TIMING_WINDOW', '1000'))
+# Metrik per tahap (histogram + counter). METRICS_PORT > 0 membuka endpoint teks
+# Prometheus di METRICS_HOST:METRICS_PORT/metrics; TRACE_LOG mencetak setiap span
+# sebagai JSON. /stats hanya untuk ID pengguna di ADMIN_USER_IDS (dipisah koma).
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+TRACE_LOG = os.getenv('TRACE_LOG', 'false').lower() in ('1', 'true', 'yes')
+ADMIN_USER_IDS = {user_id.strip() for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+# Anggaran token prompt jawaban (konteks + riwayat, diperkirakan ~4 karakter/token).
+# Riwayat memakai paling banyak HISTORY_TOKEN_SHARE dari anggaran; kandidat potongan
+# diambil RETRIEVAL_CANDIDATES, dan ditambah sampai RETRIEVAL_MAX_CANDIDATES jika
+# semuanya muat dan anggaran masih tersisa.
+# Default: 5 potongan penuh (~390 token) memakai ~1950 token, sehingga tanpa riwayat
+# panjang masih ada ruang satu potongan lagi dan penambahan kandidat bisa terjadi.
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '2500'))
+HISTORY_TOKEN_SHARE = float(os.getenv('HISTORY_TOKEN_SHARE', '0.25'))
+RETRIEVAL_CANDIDATES = int(os.getenv('RETRIEVAL_CANDIDATES', '5'))
+RETRIEVAL_MAX_CANDIDATES = int(os.getenv('RETRIEVAL_MAX_CANDIDATES', '10'))
+CHARS_PER_TOKEN = 4
+# Retrieval hibrida: hasil pencarian vektor digabung dengan pencarian kata kunci
+# (Supabase: full-text search Postgres; lokal: indeks BM25 per pengguna di memori,
+# diperbarui saat ingest/hapus). Skor tiap daftar dibagi skor terbaiknya
+# lalu dijumlahkan berbobot HYBRID_LEXICAL_WEIGHT; kandidat di bawah
+# HYBRID_RELATIVE_CUTOFF x skor terbaik dibuang (minimal HYBRID_MIN_CANDIDATES),
+# lalu MMR (MMR_LAMBDA) mendahulukan kandidat yang tidak mirip dengan yang sudah terpilih.
+# Hasil kata kunci hanya dipakai jika cocok dengan pengenal atau istilah yang cukup langka
+# (idf >= HYBRID_LEXICAL_MIN_IDF), agar kata umum tidak memunculkan kutipan tak relevan.
+HYBRID_RETRIEVAL = os.getenv('HYBRID_RETRIEVAL', 'true').lower() in ('1', 'true', 'yes')
+HYBRID_LEXICAL_WEIGHT = float(os.getenv('HYBRID_LEXICAL_WEIGHT', '0.4'))
+HYBRID_POOL_FACTOR = int(os.getenv('HYBRID_POOL_FACTOR', '2'))
+HYBRID_RELATIVE_CUTOFF = float(os.getenv('HYBRID_RELATIVE_CUTOFF', '0.35'))
+HYBRID_MIN_CANDIDATES = int(os.getenv('HYBRID_MIN_CANDIDATES', '3'))
+MMR_LAMBDA = float(os.getenv('MMR_LAMBDA', '0.7'))
+HYBRID_LEXICAL_MIN_IDF = float(os.getenv('HYBRID_LEXICAL_MIN_IDF', '1.5'))
+LEXICAL_INDEX_USERS = int(os.getenv('LEXICAL_INDEX_USERS', '200'))
+LEXICAL_INDEX_TTL = int(os.getenv('LEXICAL_INDEX_TTL', '3600'))
+# Ringkasan map-reduce: model untuk meringkas kelompok potongan dan ukuran kelompoknya
+SUMMARY_MODEL_NAME = os.getenv('SUMMARY_MODEL', 'gemini-2.5-flash')
+SUMMARY_GROUP_CHARS = int(os.getenv('SUMMARY_GROUP_CHARS', '24000'))
+
+# Riwayat percakapan lengkap untuk /export disimpan per pengguna di HISTORY_DIR
+# (JSONL, entri terbaru EXPORT_HISTORY_LIMIT). Prompt tetap memakai 5 entri terakhir.
+HISTORY_DIR = os.getenv('HISTORY_DIR', 'chat_history')
+EXPORT_HISTORY_LIMIT = int(os.getenv('EXPORT_HISTORY_LIMIT', '500'))
+# Font TTF Unicode untuk PDF ekspor (kosong = cari DejaVu Sans di lokasi sistem)
+EXPORT_FONT_PATH = os.getenv('EXPORT_FONT_PATH') or None
+EXPORT_FONT_BOLD_PATH = os.getenv('EXPORT_FONT_BOLD_PATH') or None
 
 # Konfigurasi Model
-multimodal_model = genai.GenerativeModel('gemini-2.5-flash')
-generative_model = genai.GenerativeModel('gemini-2.5-pro')
+multimodal_model = LazyModel('gemini-2.5-flash')
+generative_model = LazyModel('gemini-2.5-pro')
+refine_model = LazyModel(REFINE_MODEL_NAME)
+summary_model = LazyModel(SUMMARY_MODEL_NAME)
 embedding_model_name = 'models/text-embedding-004'
 
-# Inisialisasi Text Splitter
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=1500,
-    chunk_overlap=300,
-    length_function=len,
-)
+# Batas konkurensi per layanan eksternal (panggilan yang berjalan bersamaan)
+GEMINI_CONCURRENCY = int(os.getenv('GEMINI_CONCURRENCY', '8'))
+EMBED_CONCURRENCY = int(os.getenv('EMBED_CONCURRENCY', '4'))
+SUPABASE_CONCURRENCY = int(os.getenv('SUPABASE_CONCURRENCY', '16'))
+LOCAL_STORE_CONCURRENCY = int(os.getenv('LOCAL_STORE_CONCURRENCY', '4'))
+# Jumlah update Telegram yang boleh diproses bersamaan (1 = berurutan seperti dulu)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Pipeline embedding: ukuran batch, jumlah batch yang berjalan bersamaan,
+# jumlah worker insert, dan kebijakan retry untuk kesalahan kuota/jaringan
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '128'))
+EMBED_PIPELINE_DEPTH = int(os.getenv('EMBED_PIPELINE_DEPTH', '3'))
+INSERT_WORKERS = int(os.getenv('INSERT_WORKERS', '2'))
+MAX_RETRIES = int(os.getenv('MAX_RETRIES', '5'))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+PROGRESS_EDIT_INTERVAL = 2.0
+# Supabase membatasi hasil select ke 1000 baris per permintaan
+DB_PAGE_SIZE = 1000
+
+# Deskripsi gambar: jumlah gambar yang di-caption bersamaan, ukuran minimum
+# gambar (gambar kecil/dekoratif dilewati), dan cache caption yang dipersist ke disk
+CAPTION_CONCURRENCY = int(os.getenv('CAPTION_CONCURRENCY', '4'))
+MIN_IMAGE_BYTES = int(os.getenv('MIN_IMAGE_BYTES', '4096'))
+MIN_IMAGE_SIDE = int(os.getenv('MIN_IMAGE_SIDE', '64'))
+CAPTION_CACHE_SIZE = int(os.getenv('CAPTION_CACHE_SIZE', '5000'))
+CAPTION_CACHE_PATH = os.getenv('CAPTION_CACHE_PATH', 'caption_cache.json')
+
+# Cache query: embedding pertanyaan dan hasil pencarian per pengguna (TTL dalam detik)
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '2048'))
+QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', '3600'))
+RETRIEVAL_CACHE_USERS = int(os.getenv('RETRIEVAL_CACHE_USERS', '1000'))
+RETRIEVAL_CACHE_SIZE = int(os.getenv('RETRIEVAL_CACHE_SIZE', '128'))
+RETRIEVAL_CACHE_TTL = float(os.getenv('RETRIEVAL_CACHE_TTL', '600'))
 
-# 3. DEFINISI FUNGSI-FUNGSI INTI
-# GANTI FUNGSI LAMA ANDA DENGAN VERSI STABIL INI
+# Streaming jawaban: aktif/tidak, dan jeda minimum antar edit pesan (detik)
+STREAM_ANSWERS = os.getenv('STREAM_ANSWERS', 'true').lower() in ('1', 'true', 'yes')
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+TELEGRAM_MESSAGE_LIMIT = 4096
 
+# Jumlah halaman PDF yang diekstrak, di-embed, dan disimpan per jendela (checkpoint)
+PDF_PAGE_WINDOW = int(os.getenv('PDF_PAGE_WINDOW', '10'))
+# Jumlah pengguna yang katalog dokumennya disimpan di memori
+CATALOG_CACHE_SIZE = int(os.getenv('CATALOG_CACHE_SIZE', '1000'))
 
-async def chunk_and_embed_content(update: Update, context: ContextTypes.DEFAULT_TYPE, content_list: list, file_name: str, user_id: str):
+# Ekstraksi dan chunking PDF/DOCX/TXT berjalan di process pool (0 = di thread pool I/O).
+# Halaman PDF dibagi ke worker per EXTRACTION_PAGES_PER_TASK halaman. Dengan satu CPU,
+# worker hanya berebut inti dengan event loop dan menambah biaya spawn, jadi default 0.
+_cpu_count = os.cpu_count() or 1
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', str(min(4, _cpu_count) if _cpu_count >= 2 else 0)))
+EXTRACTION_PAGES_PER_TASK = int(os.getenv('EXTRACTION_PAGES_PER_TASK', '8'))
+
+# Penjadwal ingest: jumlah dokumen yang diproses bersamaan (bergiliran antar pengguna;
+# unggahan lain menunggu di antrean per pengguna) dan batas laju permintaan per menit
+# untuk setiap model Gemini (0 = tanpa batas). RATE_LIMIT_BURST = kapasitas burst
+# dalam detik laju.
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '2'))
+EMBED_RPM = int(os.getenv('EMBED_RPM', '1500'))
+FLASH_RPM = int(os.getenv('FLASH_RPM', '1000'))
+PRO_RPM = int(os.getenv('PRO_RPM', '150'))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '5'))
+
+# 3. LAPISAN EKSEKUSI ASINKRON
+# Klien Gemini dan Supabase bersifat sinkron. Semua panggilan ke sana dijalankan
+# di thread pool agar event loop tetap melayani pengguna lain, dengan batas
+# konkurensi terpisah untuk setiap layanan.
+SERVICE_LIMITS = {
+    'gemini': GEMINI_CONCURRENCY,
+    'embed': EMBED_CONCURRENCY,
+    'supabase': SUPABASE_CONCURRENCY,
+    'local_store': LOCAL_STORE_CONCURRENCY,
+    'cpu': 1,
+}
+_executor = ThreadPoolExecutor(max_workers=sum(SERVICE_LIMITS.values()), thread_name_prefix='rag-io')
+RATE_LIMITS = {'embed': EMBED_RPM, 'flash': FLASH_RPM, 'pro': PRO_RPM}
+
+# Prioritas permintaan: pertanyaan pengguna (interaktif) dilayani lebih dulu daripada
+# ingest dan ringkasan (bulk) saat menunggu slot konkurensi atau token rate limit.
+# Disimpan di contextvar sehingga berlaku untuk semua panggilan dalam satu task.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+request_priority = contextvars.ContextVar('request_priority', default=PRIORITY_INTERACTIVE)
+
+class PrioritySemaphore:
+    """Semaphore yang memberikan slot kosong ke penunggu dengan prioritas tertinggi (angka terkecil), lalu FIFO."""
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters = []
+        self._seq = itertools.count()
+
+    async def acquire(self):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (request_priority.get(), next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # Slot sudah diberikan tepat sebelum dibatalkan
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+class TokenBucket:
     """
-    Fungsi generik untuk chunking, embedding, dan penyimpanan
-    yang dioptimalkan untuk batch size besar dan stabilitas.
+    Pembatas laju token bucket: `rate` permintaan/detik dengan kapasitas burst
+    `capacity`. Penunggu dilayani menurut prioritas lalu urutan datang, dan satu
+    timer membangunkan penunggu saat token berikutnya tersedia.
     """
-    BATCH_SIZE = 128
-    total_chunks = len(content_list)
-    
-    # Simpan ID pesan progres pertama kali
-    sent_message = await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Memproses {total_chunks} potongan teks...")
-    context.user_data['progress_message_id'] = sent_message.message_id
-    
-    # Kembali menggunakan loop sekuensial yang lebih stabil
-    for i in range(0, total_chunks, BATCH_SIZE):
-        batch_items = content_list[i:i + BATCH_SIZE]
-        
-        progress_msg = f"Memproses potongan {i+1}-{min(i+BATCH_SIZE, total_chunks)} dari {total_chunks}..."
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _dispatch(self):
+        self._timer = None
+        self._refill()
+        while self._waiters and self.tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+        if self._waiters:
+            self._timer = asyncio.get_running_loop().call_later((1 - self.tokens) / self.rate, self._dispatch)
+
+    async def acquire(self):
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (request_priority.get(), next(self._seq), future))
+        if self._timer is None:
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.tokens += 1
+            raise
+
+_semaphores = {}
+_rate_limiters = {}
+_semaphore_loop = None
+
+def _bind_loop():
+    global _semaphore_loop
+    loop = asyncio.get_running_loop()
+    if _semaphore_loop is not loop:
+        # Semaphore dan rate limiter terikat ke event loop; buat ulang jika loop berganti
+        _semaphores.clear()
+        _rate_limiters.clear()
+        _semaphore_loop = loop
+
+def _get_semaphore(service: str) -> PrioritySemaphore:
+    _bind_loop()
+    if service not in _semaphores:
+        _semaphores[service] = PrioritySemaphore(SERVICE_LIMITS[service])
+    return _semaphores[service]
+
+async def run_blocking(service: str, func, *args, **kwargs):
+    """
+    Menjalankan fungsi sinkron di thread pool tanpa memblokir event loop.
+    Jumlah panggilan bersamaan per layanan dibatasi oleh SERVICE_LIMITS.
+    """
+    async with _get_semaphore(service):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def percentile(values, p: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+class _Span:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start, error=exc_type is not None)
+        return False
+
+class Metrics:
+    """
+    Histogram waktu per tahap (bucket ala Prometheus untuk endpoint, plus jendela
+    TIMING_WINDOW sampel terakhir untuk persentil /stats) dan counter. Jika
+    dinonaktifkan, span() mengembalikan context manager kosong dan observe()/count()
+    langsung kembali.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, enabled: bool, window: int):
+        self.enabled = enabled
+        self.window = window
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._null_span = contextlib.nullcontext()
+
+    def span(self, stage: str):
+        return _Span(self, stage) if self.enabled else self._null_span
+
+    def observe(self, stage: str, seconds: float, error: bool = False):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'sum': 0.0, 'count': 0,
+                                                  'errors': 0, 'recent': deque(maxlen=self.window)}
+            histogram['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            histogram['errors'] += error
+            histogram['recent'].append(seconds)
+        if TRACE_LOG:
+            print(json.dumps({'span': stage, 'ms': round(seconds * 1000, 1), 'ok': not error}))
+
+    def count(self, name: str, value: int = 1, label: str = None):
+        if not self.enabled or not value:
+            return
+        with self._lock:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self, prefix: str = '') -> dict:
+        """Jumlah, error, dan p50/p95/p99 (detik) dari sampel terbaru setiap tahap."""
+        with self._lock:
+            items = [(stage, h['count'], h['errors'], list(h['recent'])) for stage, h in self.stages.items() if stage.startswith(prefix)]
+        return {stage: {'count': count, 'errors': errors, 'p50': percentile(recent, 50),
+                        'p95': percentile(recent, 95), 'p99': percentile(recent, 99)}
+                for stage, count, errors, recent in sorted(items)}
+
+    def render_prometheus(self, gauges: dict = None) -> str:
+        """Format teks eksposisi Prometheus; gauges = {(nama, ((label, nilai), ...)): angka}."""
+        lines = ["# TYPE rag_stage_seconds histogram"]
+        with self._lock:
+            stages = [(stage, list(h['buckets']), h['sum'], h['count'], h['errors']) for stage, h in sorted(self.stages.items())]
+            counters = sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+        for stage, buckets, total, count, _ in stages:
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS + (float('inf'),), buckets):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'rag_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'rag_stage_seconds_count{{stage="{stage}"}} {count}')
+        lines.append("# TYPE rag_stage_errors_total counter")
+        lines += [f'rag_stage_errors_total{{stage="{stage}"}} {errors}' for stage, _, _, _, errors in stages]
+        for (name, label), value in counters:
+            labels = f'{{label="{label}"}}' if label else ''
+            lines.append(f"rag_{name}_total{labels} {value}")
+        for (name, labels), value in (gauges or {}).items():
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"rag_{name}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_ENABLED, TIMING_WINDOW)
+
+async def rate_limit(bucket: str):
+    """Menunggu token untuk satu permintaan ke model `bucket` (embed/flash/pro)."""
+    rpm = RATE_LIMITS.get(bucket, 0)
+    if rpm <= 0:
+        return
+    _bind_loop()
+    limiter = _rate_limiters.get(bucket)
+    if limiter is None:
+        limiter = _rate_limiters[bucket] = TokenBucket(rpm / 60, rpm / 60 * RATE_LIMIT_BURST)
+    with metrics.span(f"ratelimit.{bucket}"):
+        await limiter.acquire()
+
+def model_bucket(model) -> str:
+    name = getattr(model, 'model_name', '').split('/')[-1]
+    return 'pro' if 'pro' in name.split('-') else 'flash'
+
+def record_usage(stage: str, response):
+    """Menghitung token masuk/keluar dari usage_metadata respons Gemini (jika ada)."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        metrics.count('tokens_in', getattr(usage, 'prompt_token_count', 0) or 0, stage)
+        metrics.count('tokens_out', getattr(usage, 'candidates_token_count', 0) or 0, stage)
+
+async def embed_content(**kwargs):
+    await rate_limit('embed')
+    content = kwargs.get('content')
+    metrics.count('embedded_texts', len(content) if isinstance(content, list) else 1)
+    with metrics.span('gemini.embed'):
+        return await run_blocking('embed', lambda: get_genai().embed_content(**kwargs))
+
+async def generate_content(model, contents, stage: str = 'gemini.generate', **kwargs):
+    await rate_limit(model_bucket(model))
+    with metrics.span(stage):
+        # Atribut LazyModel di-resolve di thread (bisa mengimpor google.generativeai)
+        response = await run_blocking('gemini', lambda: model.generate_content(contents, **kwargs))
+    record_usage(stage, response)
+    return response
+
+async def stream_content(model, contents, stage: str = 'gemini.stream', **kwargs):
+    """
+    Versi streaming generate_content: iterasi respons (yang memblokir) berjalan
+    di thread pool, dan setiap potongan teks diteruskan ke event loop begitu tiba.
+    Waktu sampai potongan pertama dicatat sebagai tahap `<stage>.first_token`.
+    """
+    await rate_limit(model_bucket(model))
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        started = time.perf_counter()
+        first_token, last_chunk, failed = False, None, False
+        try:
+            for chunk in model.generate_content(contents, stream=True, **kwargs):
+                if stop.is_set():
+                    break
+                last_chunk = chunk
+                if chunk.parts:
+                    if not first_token:
+                        first_token = True
+                        metrics.observe(f"{stage}.first_token", time.perf_counter() - started)
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk.text)
+        except Exception as e:
+            failed = True
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            metrics.observe(stage, time.perf_counter() - started, error=failed)
+            if last_chunk is not None:
+                record_usage(stage, last_chunk)
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    async with _get_semaphore('gemini'):
+        future = loop.run_in_executor(_executor, produce)
+        try:
+            while (item := await queue.get()) is not done:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Konsumen berhenti lebih awal: hentikan iterasi di thread
+            stop.set()
+        await future
+
+_process_pool = None
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None and EXTRACTION_WORKERS > 0:
+        # 'spawn' aman dipakai bersama thread pool I/O (fork dari proses multi-thread tidak aman)
+        _process_pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _process_pool
+
+async def run_cpu(func, *args):
+    """Menjalankan fungsi CPU-bound (dari modul extraction) di process pool."""
+    pool = get_process_pool()
+    with metrics.span(f"cpu.{func.__name__}"):
+        if pool is None:
+            return await run_blocking('cpu', func, *args)
+        return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(func, *args))
+
+async def db_execute(build_query, stage: str = 'supabase.query'):
+    """
+    Eksekusi query Supabase (table/rpc) secara asinkron. build_query(klien) menyusun
+    query di thread pool juga, sehingga klien tidak pernah dibuat di event loop.
+    """
+    with metrics.span(stage):
+        return await run_blocking('supabase', lambda: build_query(get_supabase()).execute())
+
+class TTLCache:
+    """
+    Cache LRU berukuran terbatas dengan masa berlaku per entri.
+    ttl=None berarti entri tidak pernah kedaluwarsa (hanya dibuang oleh LRU).
+    """
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or (self.ttl is not None and time.monotonic() - entry[1] > self.ttl):
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def peek(self, key, default=None):
+        """Seperti get, tetapi tanpa mengubah urutan LRU maupun hitungan hit/miss."""
+        entry = self._data.get(key)
+        if entry is None or (self.ttl is not None and time.monotonic() - entry[1] > self.ttl):
+            return default
+        return entry[0]
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def items(self):
+        return [(key, entry[0]) for key, entry in self._data.items()]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+# 4. PENYIMPANAN VEKTOR
+# Semua akses ke potongan dokumen (insert, hapus, pencarian, daftar file) melalui
+# antarmuka VectorStore. Backend dipilih lewat VECTOR_STORE: 'supabase' (tabel
+# documents + RPC match_documents) atau 'local' (matriks float32 memory-mapped per pengguna).
+class VectorStore:
+    """
+    Antarmuka penyimpanan potongan dokumen beserta embedding-nya.
+    Baris memakai kolom yang sama dengan tabel documents: content, page_number,
+    embedding, file_name, user_id, content_hash, chunk_index (urutan potongan
+    di dalam halamannya).
+    """
+    async def insert(self, rows: list):
+        raise NotImplementedError
+
+    async def delete_file(self, user_id: str, file_name: str) -> int:
+        """Menghapus semua potongan sebuah file, mengembalikan jumlah baris terhapus."""
+        raise NotImplementedError
+
+    async def delete_ids(self, user_id: str, ids: list):
+        raise NotImplementedError
+
+    async def file_rows(self, user_id: str, file_name: str) -> list:
+        """Mengembalikan id, content_hash, page_number, dan chunk_index semua potongan sebuah file."""
+        raise NotImplementedError
+
+    async def set_chunk_indexes(self, user_id: str, positions: dict):
+        """Memperbarui chunk_index baris yang urutannya bergeser: {id: chunk_index}."""
+        raise NotImplementedError
+
+    async def search(self, user_id: str, embedding: list, match_threshold: float, match_count: int, file_name: str = None) -> list:
+        """Top-k potongan dengan kemiripan kosinus >= match_threshold, diurutkan menurun."""
+        raise NotImplementedError
+
+    async def lexical_search(self, user_id: str, question: str, limit: int, file_name: str = None) -> list:
+        """
+        Pencarian kata kunci untuk retrieval hibrida: [(skor, potongan), ...] urut
+        menurun, hanya potongan yang cocok dengan pengenal atau istilah langka
+        (lihat HYBRID_LEXICAL_MIN_IDF). Daftar kosong berarti pakai hasil vektor saja.
+        """
+        raise NotImplementedError
+
+    async def list_files(self, user_id: str) -> list:
+        raise NotImplementedError
+
+    async def has_documents(self, user_id: str) -> bool:
+        raise NotImplementedError
+
+    async def get_chunks(self, user_id: str, file_name: str = None, limit: int = None) -> list:
+        """Potongan (content, file_name, page_number, chunk_index) sesuai urutan penyimpanan."""
+        raise NotImplementedError
+
+    async def load_catalog(self, user_id: str) -> list:
+        """Entri katalog dokumen pengguna (lihat DocumentCatalog)."""
+        raise NotImplementedError
+
+    async def save_catalog_entry(self, entry: dict):
+        raise NotImplementedError
+
+    async def delete_catalog_entry(self, user_id: str, file_name: str):
+        raise NotImplementedError
+
+class SupabaseVectorStore(VectorStore):
+    async def insert(self, rows: list):
+        await with_retry(db_execute, lambda client: client.table('documents').insert(rows), stage='supabase.insert')
+
+    async def delete_file(self, user_id: str, file_name: str) -> int:
+        response = await db_execute(lambda client: client.table('documents').delete(count='exact').eq('user_id', user_id).eq('file_name', file_name))
+        return response.count or 0
+
+    async def delete_ids(self, user_id: str, ids: list):
+        # Batch kecil agar filter in_ tidak membuat URL permintaan terlalu panjang
+        for i in range(0, len(ids), 200):
+            batch = ids[i:i + 200]
+            await with_retry(db_execute, lambda client: client.table('documents').delete().eq('user_id', user_id).in_('id', batch))
+
+    async def _select_all(self, columns: str, user_id: str, file_name: str = None, limit: int = None) -> list:
+        # Supabase membatasi hasil select per permintaan, jadi ambil per halaman
+        rows = []
+        def build_query(client, start: int, end: int):
+            query = client.table('documents').select(columns).eq('user_id', user_id)
+            if file_name:
+                query = query.eq('file_name', file_name)
+            return query.order('id').range(start, end)
+
+        while limit is None or len(rows) < limit:
+            page_size = DB_PAGE_SIZE if limit is None else min(DB_PAGE_SIZE, limit - len(rows))
+            start = len(rows)
+            response = await db_execute(lambda client: build_query(client, start, start + page_size - 1))
+            rows.extend(response.data)
+            if len(response.data) < page_size:
+                break
+        return rows
+
+    async def file_rows(self, user_id: str, file_name: str) -> list:
+        return await self._select_all('id, content_hash, page_number, chunk_index', user_id, file_name)
+
+    async def set_chunk_indexes(self, user_id: str, positions: dict):
+        # Nilai berbeda per baris: satu update per id (hanya baris yang bergeser)
+        def update(row_id, index: int):
+            return with_retry(db_execute, lambda client: client.table('documents').update({'chunk_index': index}).eq('user_id', user_id).eq('id', row_id))
+        await asyncio.gather(*(update(row_id, index) for row_id, index in positions.items()))
+
+    async def search(self, user_id: str, embedding: list, match_threshold: float, match_count: int, file_name: str = None) -> list:
+        params = {'query_embedding': embedding, 'user_id_input': user_id, 'match_threshold': match_threshold, 'match_count': match_count}
+        function_name = 'match_documents'
+        if file_name:
+            function_name = 'match_documents_by_file'
+            params['file_name_input'] = file_name
+        response = await db_execute(lambda client: client.rpc(function_name, params), stage=f'supabase.{function_name}')
+        return response.data if response.data else []
+
+    async def lexical_search(self, user_id: str, question: str, limit: int, file_name: str = None) -> list:
+        # Full-text search Postgres (kolom fts + indeks GIN): korpus tidak perlu diunduh.
+        # Stopword dibuang di sini; pemilihan istilah langka dilakukan di RPC.
+        terms = sorted(set(lexical.tokenize(question)) - lexical.STOPWORDS)
+        if not terms:
+            return []
+        params = {'query_terms': terms, 'user_id_input': user_id, 'match_count': limit,
+                  'min_idf': HYBRID_LEXICAL_MIN_IDF, 'file_name_input': file_name}
+        response = await db_execute(lambda client: client.rpc('match_documents_text', params), stage='supabase.match_documents_text')
+        return [(row['rank'], row) for row in response.data or []]
+
+    async def list_files(self, user_id: str) -> list:
+        rows = await self._select_all('file_name', user_id)
+        return sorted(set(row['file_name'] for row in rows))
+
+    async def has_documents(self, user_id: str) -> bool:
+        response = await db_execute(lambda client: client.table('documents').select('id').eq('user_id', user_id).limit(1))
+        return bool(response.data)
+
+    async def get_chunks(self, user_id: str, file_name: str = None, limit: int = None) -> list:
+        return await self._select_all('content, file_name, page_number, chunk_index', user_id, file_name, limit)
+
+    async def load_catalog(self, user_id: str) -> list:
+        response = await db_execute(lambda client: client.table('document_catalog').select('*').eq('user_id', user_id))
+        return response.data or []
+
+    async def save_catalog_entry(self, entry: dict):
+        await with_retry(db_execute, lambda client: client.table('document_catalog').upsert(entry, on_conflict='user_id,file_name'))
+
+    async def delete_catalog_entry(self, user_id: str, file_name: str):
+        await db_execute(lambda client: client.table('document_catalog').delete().eq('user_id', user_id).eq('file_name', file_name))
+
+class _LocalUserIndex:
+    """
+    Indeks lokal satu pengguna: embeddings.f32 (matriks float32 n x dim, baris
+    sudah dinormalisasi) dibuka sebagai memmap, dan meta.jsonl berisi metadata
+    setiap baris dengan urutan yang sama.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.meta = []
+        self.matrix = None
+        self.file_names = None
+        self.dim = None
+        self.next_id = 1
+        self.catalog = {}
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        if os.path.exists(self._path('catalog.json')):
+            with open(self._path('catalog.json'), 'r', encoding='utf-8') as f:
+                self.catalog = json.load(f)
+        if os.path.exists(self._path('meta.jsonl')):
+            with open(self._path('meta.jsonl'), 'r', encoding='utf-8') as f:
+                self.meta = [json.loads(line) for line in f if line.strip()]
+        if os.path.exists(self._path('info.json')):
+            with open(self._path('info.json'), 'r', encoding='utf-8') as f:
+                self.dim = json.load(f)['dim']
+        if self.dim and os.path.exists(self._path('embeddings.f32')):
+            # Jika proses terhenti di tengah insert, pakai bagian yang ada di kedua file
+            stored_rows = os.path.getsize(self._path('embeddings.f32')) // (4 * self.dim)
+            if stored_rows != len(self.meta):
+                self.meta = self.meta[:stored_rows]
+                matrix = np.asarray(self._memmap(len(self.meta))) if self.meta else np.empty((0, self.dim), dtype=np.float32)
+                self._rewrite(matrix, self.meta)
+                return
+        self.next_id = max((row['id'] for row in self.meta), default=0) + 1
+        self._reopen()
+
+    def _memmap(self, rows: int):
+        return np.memmap(self._path('embeddings.f32'), dtype=np.float32, mode='r', shape=(rows, self.dim))
+
+    def _reopen(self):
+        self.matrix = self._memmap(len(self.meta)) if self.meta else None
+        self.file_names = np.array([row['file_name'] for row in self.meta], dtype=object)
+
+    def _write_meta(self, meta: list):
+        tmp_path = self._path('meta.jsonl.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in meta)
+        os.replace(tmp_path, self._path('meta.jsonl'))
+        self.meta = meta
+
+    def _rewrite(self, matrix, meta: list):
+        tmp_path = self._path('embeddings.f32.tmp')
+        matrix.astype(np.float32).tofile(tmp_path)
+        os.replace(tmp_path, self._path('embeddings.f32'))
+        self._write_meta(meta)
+        self.next_id = max([self.next_id] + [row['id'] + 1 for row in meta])
+        self._reopen()
+
+    def insert(self, rows: list):
+        vectors = np.asarray([row['embedding'] for row in rows], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        with self.lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self._path('info.json'), 'w', encoding='utf-8') as f:
+                    json.dump({'dim': self.dim}, f)
+            new_meta = []
+            for row in rows:
+                new_meta.append({'id': self.next_id, 'file_name': row['file_name'], 'page_number': row.get('page_number', 1),
+                                 'content': row['content'], 'content_hash': row.get('content_hash'),
+                                 'chunk_index': row.get('chunk_index')})
+                self.next_id += 1
+            # Embedding ditulis lebih dulu; _load memotong meta jika keduanya tidak sinkron
+            with open(self._path('embeddings.f32'), 'ab') as f:
+                vectors.tofile(f)
+            with open(self._path('meta.jsonl'), 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in new_meta)
+            self.meta = self.meta + new_meta
+            self._reopen()
+
+    def update_catalog(self, file_name: str, entry: dict = None):
+        with self.lock:
+            catalog = dict(self.catalog)
+            if entry is None: catalog.pop(file_name, None)
+            else: catalog[file_name] = entry
+            tmp_path = self._path('catalog.json.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(catalog, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path('catalog.json'))
+            self.catalog = catalog
+
+    def set_chunk_indexes(self, positions: dict):
+        with self.lock:
+            # Embedding tidak berubah: cukup tulis ulang meta
+            self._write_meta([{**row, 'chunk_index': positions[row['id']]} if row['id'] in positions else row for row in self.meta])
+
+    def delete_where(self, predicate) -> int:
+        with self.lock:
+            keep = [i for i, row in enumerate(self.meta) if not predicate(row)]
+            deleted = len(self.meta) - len(keep)
+            if deleted:
+                matrix = np.asarray(self.matrix[keep]) if keep else np.empty((0, self.dim), dtype=np.float32)
+                self._rewrite(matrix, [self.meta[i] for i in keep])
+            return deleted
+
+    def search(self, embedding: list, match_threshold: float, match_count: int, file_name: str = None) -> list:
+        with self.lock:
+            matrix, meta, file_names = self.matrix, self.meta, self.file_names
+        if matrix is None or match_count <= 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= (np.linalg.norm(query) or 1.0)
+        scores = matrix @ query
+        candidates = scores >= match_threshold
+        if file_name:
+            candidates &= file_names == file_name
+        indices = np.flatnonzero(candidates)
+        if len(indices) > match_count:
+            indices = indices[np.argpartition(-scores[indices], match_count - 1)[:match_count]]
+        indices = indices[np.argsort(-scores[indices])]
+        return [{'id': meta[i]['id'], 'content': meta[i]['content'], 'file_name': meta[i]['file_name'],
+                 'page_number': meta[i]['page_number'], 'similarity': float(scores[i])} for i in indices]
+
+class LocalVectorStore(VectorStore):
+    """Backend lokal satu node: pencarian kosinus top-k tervektorisasi dengan NumPy."""
+    def __init__(self, root: str):
+        self.root = root
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _index(self, user_id: str) -> _LocalUserIndex:
+        with self._lock:
+            if user_id not in self._indexes:
+                safe_id = "".join(c for c in str(user_id) if c.isalnum() or c in '-_')
+                self._indexes[user_id] = _LocalUserIndex(os.path.join(self.root, safe_id))
+            return self._indexes[user_id]
+
+    async def _run(self, func, *args):
+        with metrics.span('local_store'):
+            return await run_blocking('local_store', func, *args)
+
+    async def insert(self, rows: list):
+        by_user = {}
+        for row in rows:
+            by_user.setdefault(row['user_id'], []).append(row)
+        for user_id, user_rows in by_user.items():
+            await self._run(lambda: self._index(user_id).insert(user_rows))
+
+    async def delete_file(self, user_id: str, file_name: str) -> int:
+        return await self._run(lambda: self._index(user_id).delete_where(lambda row: row['file_name'] == file_name))
+
+    async def delete_ids(self, user_id: str, ids: list):
+        id_set = set(ids)
+        await self._run(lambda: self._index(user_id).delete_where(lambda row: row['id'] in id_set))
+
+    async def file_rows(self, user_id: str, file_name: str) -> list:
+        meta = await self._run(lambda: self._index(user_id).meta)
+        return [{'id': row['id'], 'content_hash': row['content_hash'], 'page_number': row['page_number'], 'chunk_index': row.get('chunk_index')}
+                for row in meta if row['file_name'] == file_name]
+
+    async def set_chunk_indexes(self, user_id: str, positions: dict):
+        await self._run(lambda: self._index(user_id).set_chunk_indexes(positions))
+
+    async def search(self, user_id: str, embedding: list, match_threshold: float, match_count: int, file_name: str = None) -> list:
+        return await self._run(lambda: self._index(user_id).search(embedding, match_threshold, match_count, file_name))
+
+    async def lexical_search(self, user_id: str, question: str, limit: int, file_name: str = None) -> list:
+        # Indeks BM25 di memori dibangun di latar belakang; sampai siap, vektor saja
+        index = lexical_indexes.get_nowait(user_id)
+        if index is None:
+            return []
+        return index.search(question, limit, file_name, HYBRID_LEXICAL_MIN_IDF)
+
+    async def list_files(self, user_id: str) -> list:
+        meta = await self._run(lambda: self._index(user_id).meta)
+        return sorted(set(row['file_name'] for row in meta))
+
+    async def has_documents(self, user_id: str) -> bool:
+        return bool(await self._run(lambda: self._index(user_id).meta))
+
+    async def get_chunks(self, user_id: str, file_name: str = None, limit: int = None) -> list:
+        meta = await self._run(lambda: self._index(user_id).meta)
+        rows = [{'content': row['content'], 'file_name': row['file_name'], 'page_number': row['page_number'], 'chunk_index': row.get('chunk_index')}
+                for row in meta if not file_name or row['file_name'] == file_name]
+        return rows[:limit] if limit is not None else rows
+
+    async def load_catalog(self, user_id: str) -> list:
+        return list((await self._run(lambda: self._index(user_id).catalog)).values())
+
+    async def save_catalog_entry(self, entry: dict):
+        await self._run(lambda: self._index(entry['user_id']).update_catalog(entry['file_name'], entry))
+
+    async def delete_catalog_entry(self, user_id: str, file_name: str):
+        await self._run(lambda: self._index(user_id).update_catalog(file_name))
+
+def create_vector_store() -> VectorStore:
+    if VECTOR_STORE == 'local':
+        return LocalVectorStore(LOCAL_STORE_DIR)
+    if VECTOR_STORE == 'supabase':
+        return SupabaseVectorStore()
+    raise ValueError(f"VECTOR_STORE tidak dikenal: {VECTOR_STORE}")
+
+vector_store = create_vector_store()
+
+class DocumentCatalog:
+    """
+    Katalog dokumen per pengguna: nama file, jumlah potongan, jumlah halaman,
+    waktu ingest, dan hash isi file. Disimpan lewat VectorStore dan di-cache di
+    memori, sehingga handle_message dan list_docs tidak perlu memindai potongan.
+    """
+    def __init__(self, store: VectorStore, cache_size: int):
+        self.store = store
+        self._cache = TTLCache(cache_size)
+
+    async def entries(self, user_id: str) -> dict:
+        """{file_name: entri} untuk seorang pengguna."""
+        entries = self._cache.get(user_id)
+        if entries is None:
+            rows = await self.store.load_catalog(user_id)
+            if not rows and await self.store.has_documents(user_id):
+                rows = await self._backfill(user_id)
+            entries = {row['file_name']: row for row in rows}
+            self._cache.set(user_id, entries)
+        return entries
+
+    async def _backfill(self, user_id: str) -> list:
+        # Dokumen yang diunggah sebelum katalog ada: bangun sekali dari potongan tersimpan
+        files = {}
+        for chunk in await self.store.get_chunks(user_id):
+            entry = files.setdefault(chunk['file_name'], {'chunk_count': 0, 'page_count': 0})
+            entry['chunk_count'] += 1
+            entry['page_count'] = max(entry['page_count'], chunk.get('page_number') or 1)
+        rows = []
+        for file_name, counts in files.items():
+            rows.append({'user_id': user_id, 'file_name': file_name, 'ingested_at': None, 'content_hash': None, 'last_page': None, 'summary': None, **counts})
+            await self.store.save_catalog_entry(rows[-1])
+        return rows
+
+    async def record(self, user_id: str, file_name: str, chunk_count: int, page_count: int, content_hash: str, last_page: int = None):
+        """last_page < page_count menandai ingest yang belum selesai (checkpoint)."""
+        entry = {'user_id': user_id, 'file_name': file_name, 'chunk_count': chunk_count, 'page_count': page_count,
+                 'ingested_at': datetime.now(timezone.utc).isoformat(), 'content_hash': content_hash, 'last_page': last_page,
+                 # Isi file berubah: ringkasan lama tidak berlaku lagi
+                 'summary': None}
+        await self.store.save_catalog_entry(entry)
+        entries = self._cache.get(user_id)
+        if entries is not None:
+            entries[file_name] = entry
+
+    async def set_summary(self, user_id: str, file_name: str, summary: str):
+        """Menyimpan ringkasan file di entrinya; dibuang otomatis saat file diunggah ulang."""
+        entries = await self.entries(user_id)
+        if file_name not in entries:
+            return
+        entry = {**entries[file_name], 'summary': summary}
+        await self.store.save_catalog_entry(entry)
+        entries[file_name] = entry
+
+    async def remove(self, user_id: str, file_name: str):
+        await self.store.delete_catalog_entry(user_id, file_name)
+        entries = self._cache.get(user_id)
+        if entries is not None:
+            entries.pop(file_name, None)
+
+document_catalog = DocumentCatalog(vector_store, CATALOG_CACHE_SIZE)
+
+def is_complete(entry: dict) -> bool:
+    return entry.get('last_page') is None or entry['last_page'] >= (entry.get('page_count') or 0)
+
+# 5. DEFINISI FUNGSI-FUNGSI INTI
+
+
+class UploadCancelled(Exception):
+    """Dilempar saat pengguna mengirim /cancel di tengah proses unggah."""
+
+def _is_transient_error(exc: Exception) -> bool:
+    """Kesalahan kuota atau jaringan sementara yang layak dicoba ulang."""
+    from google.api_core import exceptions as google_exceptions
+    if isinstance(exc, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests,
+                        google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded,
+                        google_exceptions.InternalServerError)):
+        return True
+    return isinstance(exc, (httpx.TransportError, ConnectionError, TimeoutError))
+
+async def with_retry(func, *args, **kwargs):
+    """
+    Menjalankan coroutine function dengan percobaan ulang dan exponential backoff
+    (plus jitter) untuk kesalahan sementara. Kesalahan lain langsung diteruskan.
+    """
+    delay = RETRY_BASE_DELAY
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= MAX_RETRIES or not _is_transient_error(e):
+                raise
+            print(f"Percobaan {attempt + 1} gagal ({e}), diulang dalam {delay:.1f} detik...")
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+
+def chunk_hash(content: str, page_number: int) -> str:
+    """Hash isi potongan beserta nomor halamannya (disimpan di kolom content_hash)."""
+    return hashlib.sha256(f"{page_number}\x00{content}".encode('utf-8')).hexdigest()
+
+class ProgressMessage:
+    """Pesan progres di chat yang diedit paling cepat tiap PROGRESS_EDIT_INTERVAL detik."""
+    def __init__(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+        self.context = context
+        self.chat_id = chat_id
+        self.message_id = None
+        self.last_edit = 0.0
+
+    async def start(self, text: str):
+        with metrics.span('telegram.send'):
+            sent_message = await self.context.bot.send_message(chat_id=self.chat_id, text=text)
+        self.message_id = sent_message.message_id
+        self.context.user_data['progress_message_id'] = self.message_id
+
+    async def update(self, text: str, force: bool = False):
+        # Telegram membatasi frekuensi edit pesan
+        now = time.monotonic()
+        if self.message_id is None or (not force and now - self.last_edit < PROGRESS_EDIT_INTERVAL):
+            return
+        self.last_edit = now
         try:
-            await context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=context.user_data['progress_message_id'], text=progress_msg)
+            with metrics.span('telegram.edit'):
+                await self.context.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text)
         except Exception:
             pass # Abaikan jika pesan tidak berubah
 
-        # --- PERBAIKAN UTAMA DI SINI (KATA KUNCI 'await' DIHAPUS) ---
-        embedding_results = genai.embed_content(
-            model=embedding_model_name,
-            content=[item['content'] for item in batch_items],
-            task_type="RETRIEVAL_DOCUMENT"
-        )
-        
-        rows_to_insert = [{
-            'content': item['content'],
-            'page_number': item.get('page', 1),
-            'embedding': embedding_results['embedding'][j],
-            'file_name': file_name,
-            'user_id': user_id
-        } for j, item in enumerate(batch_items)]
-        
-        if rows_to_insert:
-            supabase.table('documents').insert(rows_to_insert).execute()
-        
-        await asyncio.sleep(0.1)
+    async def close(self):
+        if self.message_id is None:
+            return
+        try:
+            await self.context.bot.delete_message(chat_id=self.chat_id, message_id=self.message_id)
+        except Exception:
+            pass
+        self.message_id = None
+
+async def embed_and_store(context: ContextTypes.DEFAULT_TYPE, items: list, file_name: str, user_id: str, on_stored=None):
+    """
+    Embedding dan penyimpanan dalam bentuk pipeline: beberapa batch embedding
+    berjalan bersamaan dan tumpang tindih dengan insert ke database. Antrean
+    dibatasi agar memori tetap terkendali. on_stored(jumlah) dipanggil setiap
+    kali satu batch selesai disimpan.
+    """
+    if not items:
+        return
+    embed_queue = asyncio.Queue(maxsize=EMBED_PIPELINE_DEPTH)
+    insert_queue = asyncio.Queue(maxsize=EMBED_PIPELINE_DEPTH)
+
+    async def produce():
+        for i in range(0, len(items), EMBED_BATCH_SIZE):
+            await embed_queue.put(items[i:i + EMBED_BATCH_SIZE])
+        for _ in range(EMBED_PIPELINE_DEPTH):
+            await embed_queue.put(None)
+
+    async def embed_worker():
+        while (batch_items := await embed_queue.get()) is not None:
+            if context.user_data.get('cancel_upload', False):
+                raise UploadCancelled()
+            with metrics.span('ingest.embed_batch'):
+                embedding_results = await with_retry(
+                    embed_content,
+                    model=embedding_model_name,
+                    content=[item['content'] for item in batch_items],
+                    task_type="RETRIEVAL_DOCUMENT"
+                )
+            await insert_queue.put([{
+                'content': item['content'],
+                'page_number': item.get('page', 1),
+                'embedding': embedding_results['embedding'][j],
+                'file_name': file_name,
+                'user_id': user_id,
+                'content_hash': item['content_hash'],
+                'chunk_index': item.get('chunk_index')
+            } for j, item in enumerate(batch_items)])
+
+    async def embed_stage():
+        await asyncio.gather(*(embed_worker() for _ in range(EMBED_PIPELINE_DEPTH)))
+        for _ in range(INSERT_WORKERS):
+            await insert_queue.put(None)
+
+    async def insert_worker():
+        while (rows_to_insert := await insert_queue.get()) is not None:
+            with metrics.span('ingest.insert'):
+                await vector_store.insert(rows_to_insert)
+            lexical_indexes.add(user_id, rows_to_insert)
+            metrics.count('chunks_stored', len(rows_to_insert))
+            if on_stored:
+                await on_stored(len(rows_to_insert))
+
+    workers = [asyncio.create_task(produce()), asyncio.create_task(embed_stage())]
+    workers += [asyncio.create_task(insert_worker()) for _ in range(INSERT_WORKERS)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # Satu tahap gagal: hentikan tahap lain agar tidak menunggu antrean selamanya
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+
+class IngestSession:
+    """
+    Ingest inkremental satu file. Baris yang sudah tersimpan dikelompokkan per
+    halaman berdasarkan content_hash. Setiap commit() hanya meng-embed potongan
+    baru untuk satu rentang halaman, lalu menghapus baris lama di rentang itu
+    yang tidak lagi ada, sehingga halaman yang sudah di-commit langsung
+    konsisten dan bisa dicari. finish() menghapus baris di halaman yang sudah
+    tidak ada lagi di file. Jika commit() gagal atau dibatalkan, baris yang sempat
+    disisipkan untuk rentang itu dihapus lagi agar tidak ada potongan tanpa entri
+    katalog (atau di luar checkpoint). Commit untuk rentang halaman yang berbeda
+    boleh berjalan bersamaan.
+    """
+    def __init__(self, context: ContextTypes.DEFAULT_TYPE, file_name: str, user_id: str, existing_rows: list, on_stored=None):
+        self.context = context
+        self.file_name = file_name
+        self.user_id = user_id
+        self.on_stored = on_stored
+        self.stats = {'new': 0, 'deleted': 0, 'unchanged': 0}
+        self.known_ids = {row['id'] for row in existing_rows}
+        self.positions = {row['id']: row.get('chunk_index') for row in existing_rows}
+        self.existing = {}
+        for row in existing_rows:
+            self.existing.setdefault(row.get('page_number') or 1, {}).setdefault(row['content_hash'], []).append(row['id'])
+
+    @classmethod
+    async def open(cls, context: ContextTypes.DEFAULT_TYPE, file_name: str, user_id: str, on_stored=None):
+        return cls(context, file_name, user_id, await vector_store.file_rows(user_id, file_name), on_stored)
+
+    def skip_pages(self, last_page: int):
+        """Halaman 1..last_page sudah di-commit pada proses sebelumnya (checkpoint)."""
+        for page in [page for page in self.existing if page <= last_page]:
+            del self.existing[page]
+
+    async def commit(self, items: list, first_page: int, last_page: int):
+        new_items = []
+        moved = {}
+        page_counts = {}
+        for item in items:
+            page = item.get('page', 1)
+            item['content_hash'] = chunk_hash(item['content'], page)
+            # Urutan di dalam halaman: baris baru disisipkan di akhir tabel, dan semua
+            # potongan DOCX/TXT ada di halaman 1, jadi urutan dokumen perlu disimpan
+            item['chunk_index'] = page_counts.get(page, 0)
+            page_counts[page] = item['chunk_index'] + 1
+            # Pakai ulang satu baris lama per kemunculan; sisanya dianggap usang
+            ids = self.existing.get(page, {}).get(item['content_hash'])
+            if ids:
+                row_id = ids.pop()
+                if self.positions.get(row_id) != item['chunk_index']:
+                    moved[row_id] = item['chunk_index']
+                self.stats['unchanged'] += 1
+            else:
+                new_items.append(item)
+        stale = [(row_hash, row_id) for page in range(first_page, last_page + 1)
+                 for row_hash, ids in self.existing.pop(page, {}).items() for row_id in ids]
+        try:
+            await embed_and_store(self.context, new_items, self.file_name, self.user_id, self.on_stored)
+        except BaseException:
+            await self.rollback(first_page, last_page)
+            raise
+        # Baris usang baru dihapus setelah versi baru rentang ini tersimpan
+        await self._delete(stale)
+        if moved:
+            await vector_store.set_chunk_indexes(self.user_id, moved)
+        self.stats['new'] += len(new_items)
+
+    async def rollback(self, first_page: int, last_page: int):
+        # Baris lama tetap utuh; hanya baris baru di rentang yang gagal yang dibuang
+        try:
+            orphans = [(row['content_hash'], row['id']) for row in await vector_store.file_rows(self.user_id, self.file_name)
+                       if row['id'] not in self.known_ids and first_page <= (row.get('page_number') or 1) <= last_page]
+            await vector_store.delete_ids(self.user_id, [row_id for _, row_id in orphans])
+            lexical_indexes.remove(self.user_id, self.file_name, [row_hash for row_hash, _ in orphans])
+        except Exception as e: print(f"Gagal menghapus potongan yang belum selesai dari '{self.file_name}': {e}")
+
+    async def _delete(self, stale: list):
+        await vector_store.delete_ids(self.user_id, [row_id for _, row_id in stale])
+        lexical_indexes.remove(self.user_id, self.file_name, [row_hash for row_hash, _ in stale])
+        self.stats['deleted'] += len(stale)
+
+    async def finish(self) -> dict:
+        stale = [(row_hash, row_id) for page_rows in self.existing.values() for row_hash, ids in page_rows.items() for row_id in ids]
+        self.existing = {}
+        await self._delete(stale)
+        return self.stats
+
+async def chunk_and_embed_content(update: Update, context: ContextTypes.DEFAULT_TYPE, content_list: list, file_name: str, user_id: str) -> dict:
+    """
+    Fungsi generik untuk embedding dan penyimpanan seluruh isi file sekaligus
+    (dipakai untuk DOCX/TXT). Ingest bersifat inkremental lewat IngestSession.
+    Mengembalikan jumlah potongan baru, dihapus, dan tidak berubah.
+    """
+    progress = ProgressMessage(context, update.effective_chat.id)
+    stored = {'count': 0}
+
+    async def on_stored(count):
+        stored['count'] += count
+        await progress.update(f"Tersimpan {stored['count']} potongan baru...")
+
+    try:
+        await progress.start(f"Memproses {len(content_list)} potongan teks...")
+        session = await IngestSession.open(context, file_name, user_id, on_stored)
+        pages = [item.get('page', 1) for item in content_list] or [1]
+        await session.commit(content_list, min(pages), max(pages))
+        return await session.finish()
+    finally:
+        # Hapus pesan progres setelah semua selesai
+        await progress.close()
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def format_ingest_stats(stats: dict) -> str:
+    if not stats['new'] and not stats['deleted']:
+        return "Tidak ada perubahan sejak unggahan sebelumnya."
+    return f"({stats['new']} potongan baru, {stats['deleted']} dihapus, {stats['unchanged']} tidak berubah)"
+
+# Cache caption gambar berdasarkan hash SHA-256 byte gambar, berlaku lintas unggahan
+caption_cache = TTLCache(CAPTION_CACHE_SIZE)
+_caption_cache_loaded = False
+
+# caption_cache hanya disentuh dari event loop; thread cuma membaca/menulis file
+def read_caption_file() -> dict:
+    if CAPTION_CACHE_PATH and os.path.exists(CAPTION_CACHE_PATH):
+        try:
+            with open(CAPTION_CACHE_PATH, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e: print(f"Gagal memuat cache caption: {e}")
+    return {}
+
+async def load_caption_cache():
+    global _caption_cache_loaded
+    if _caption_cache_loaded:
+        return
+    _caption_cache_loaded = True
+    for image_hash, caption in (await asyncio.to_thread(read_caption_file)).items():
+        caption_cache.set(image_hash, caption)
+
+def save_caption_cache(snapshot: dict):
+    """Menulis salinan cache yang diambil di event loop (dipanggil di thread)."""
+    if not CAPTION_CACHE_PATH:
+        return
+    # File sementara unik: beberapa ingest bisa menyimpan bersamaan (INGEST_WORKERS > 1)
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(CAPTION_CACHE_PATH)), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, CAPTION_CACHE_PATH)
+    except Exception as e:
+        print(f"Gagal menyimpan cache caption: {e}")
+        if tmp_path:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+
+async def caption_images(images: dict) -> dict:
+    """
+    Membuat deskripsi untuk gambar unik {hash: bytes} secara paralel (dibatasi
+    CAPTION_CONCURRENCY). Hasil dari cache dipakai ulang; gambar yang gagal
+    dideskripsikan tidak ada di hasil.
+    """
+    await load_caption_cache()
+    captions = {}
+    pending = {}
+    for image_hash, image_bytes in images.items():
+        cached = caption_cache.get(image_hash)
+        if cached is not None: captions[image_hash] = cached
+        else: pending[image_hash] = image_bytes
+    semaphore = asyncio.Semaphore(CAPTION_CONCURRENCY)
+
+    async def caption_one(image_hash, image_bytes):
+        async with semaphore:
+            try:
+                from PIL import Image
+                pil_image = Image.open(io.BytesIO(image_bytes))
+                response = await with_retry(generate_content, multimodal_model, ["Jelaskan gambar ini:", pil_image], stage='gemini.caption')
+                captions[image_hash] = response.text.strip()
+                caption_cache.set(image_hash, captions[image_hash])
+            except Exception as e: print(f"Gagal deskripsi gambar {image_hash[:12]}: {e}")
+
+    await asyncio.gather(*(caption_one(h, b) for h, b in pending.items()))
+    if pending:
+        await asyncio.to_thread(save_caption_cache, dict(caption_cache.items()))
+    return captions
 
-    # Hapus pesan progres setelah semua selesai
+async def iter_pdf_pages(pdf_path: str, start: int, total_pages: int):
+    """
+    Menghasilkan halaman PDF (lihat extraction.extract_pdf_pages) secara berurutan
+    mulai dari indeks start. Rentang halaman dikerjakan paralel di process pool,
+    dengan jumlah rentang yang sedang diproses dibatasi agar memori tetap terkendali.
+    """
+    ranges = iter([(i, min(i + EXTRACTION_PAGES_PER_TASK, total_pages)) for i in range(start, total_pages, EXTRACTION_PAGES_PER_TASK)])
+    pending = deque()
+
+    def submit_next():
+        page_range = next(ranges, None)
+        if page_range:
+            pending.append(asyncio.ensure_future(run_cpu(extraction.extract_pdf_pages, pdf_path, *page_range, MIN_IMAGE_BYTES, MIN_IMAGE_SIDE)))
+
+    for _ in range(max(1, EXTRACTION_WORKERS) * 2):
+        submit_next()
     try:
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['progress_message_id'])
-    except Exception:
-        pass
-async def process_and_store_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, pdf_path: str, file_name: str, user_id: str, start_time: float):
+        while pending:
+            pages = await pending.popleft()
+            submit_next()
+            for page in pages:
+                yield page
+    finally:
+        for future in pending:
+            future.cancel()
+
+async def build_window_content(pages: list, seen_images: set) -> list:
+    """
+    Menyusun potongan untuk satu jendela halaman: teks halaman, lalu deskripsi
+    gambar yang belum pernah muncul di jendela sebelumnya (seen_images), sehingga
+    logo/header berulang cukup dideskripsikan sekali di halaman pertama kemunculannya.
+    """
+    unique_images = {}
+    for page in pages:
+        page['images'] = [image for image in page['images'] if image[0] not in seen_images]
+        for image_hash, image_bytes in page['images']:
+            seen_images.add(image_hash)
+            unique_images[image_hash] = image_bytes
+    # Deskripsikan semua gambar unik di jendela ini secara paralel
+    captions = await caption_images(unique_images) if unique_images else {}
+    content = []
+    for page in pages:
+        for chunk in page['chunks']: content.append({'content': chunk, 'page': page['page']})
+        for image_hash, _ in page['images']:
+            if image_hash in captions:
+                img_chunks = extraction.get_text_splitter().split_text(f"[Deskripsi Gambar: {captions[image_hash]}]")
+                for chunk in img_chunks: content.append({'content': chunk, 'page': page['page']})
+    return content
+
+async def process_and_store_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, pdf_path: str, file_name: str, user_id: str, start_time: float, file_hash: str = None, resume_from: int = 0):
+    """
+    Memproses PDF per jendela PDF_PAGE_WINDOW halaman: ekstrak, embed, dan simpan,
+    sehingga halaman yang selesai langsung bisa dicari. Commit jendela berjalan di
+    latar belakang sementara jendela berikutnya diekstrak; jendela baru terus
+    dimulai selama potongan yang belum tersimpan kurang dari satu pipeline penuh
+    (EMBED_BATCH_SIZE * EMBED_PIPELINE_DEPTH), agar beberapa batch embedding tetap
+    berjalan dan memori tetap terbatas. Checkpoint (halaman terakhir tersimpan)
+    dicatat di katalog berurutan, setelah semua jendela sebelumnya selesai;
+    unggahan ulang file yang sama melanjutkan dari resume_from.
+    """
+    chat_id = update.effective_chat.id
+    progress = ProgressMessage(context, chat_id)
+    committed_page = resume_from
+    pages = None
+    # Commit jendela yang sedang berjalan: (task, jumlah potongan, halaman terakhir)
+    in_flight = deque()
+    launched_page = resume_from
     try:
-        all_content_to_process = []
-        doc = fitz.open(pdf_path)
-        for i, page in enumerate(doc):
+        total_pages = await run_cpu(extraction.pdf_page_count, pdf_path)
+        chunk_count = 0
+        if resume_from:
+            chunk_count = (await document_catalog.entries(user_id)).get(file_name, {}).get('chunk_count') or 0
+        stored = {'count': 0}
+
+        async def on_stored(count):
+            stored['count'] += count
+            await progress.update(f"Halaman {committed_page} dari {total_pages} tersimpan, {stored['count']} potongan baru...")
+
+        session = await IngestSession.open(context, file_name, user_id, on_stored)
+        session.skip_pages(resume_from)
+        await progress.start(f"Memproses {total_pages} halaman" + (f" (melanjutkan dari halaman {resume_from + 1})..." if resume_from else "..."))
+        async def checkpoint():
+            nonlocal chunk_count, committed_page
+            count = 0
+            # Jendela terlama ditunggu; jendela berikutnya yang sudah berhasil ikut dicatat
+            while True:
+                task, window_count, last_page = in_flight[0]
+                await task
+                in_flight.popleft()
+                count += window_count
+                if not in_flight or not in_flight[0][0].done() or in_flight[0][0].exception():
+                    break
+            # Checkpoint: halaman 1..last_page sudah tersimpan dan bisa dicari
+            await document_catalog.record(user_id, file_name, chunk_count + count, total_pages, file_hash, last_page=last_page)
+            chunk_count += count
+            committed_page = last_page
+            invalidate_user_cache(user_id)
+            await progress.update(f"Halaman {committed_page} dari {total_pages} tersimpan dan sudah bisa dicari...", force=True)
+
+        pipeline_chunks = EMBED_BATCH_SIZE * EMBED_PIPELINE_DEPTH
+        seen_images = set()
+        window = []
+        pages = iter_pdf_pages(pdf_path, resume_from, total_pages)
+        async for page in pages:
             if context.user_data.get('cancel_upload', False):
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=f"⚠️ Proses unggah dibatalkan.", parse_mode=ParseMode.HTML)
-                supabase.table('documents').delete().eq('user_id', user_id).eq('file_name', file_name).execute()
-                return
-            page_number = i + 1
-            text = page.get_text("text")
-            if text:
-                chunks = text_splitter.split_text(text)
-                for chunk in chunks: all_content_to_process.append({'content': chunk, 'page': page_number})
-            image_list = page.get_images(full=True)
-            if image_list:
-                for img_info in image_list:
-                    try:
-                        base_image = doc.extract_image(img_info[0])
-                        pil_image = Image.open(io.BytesIO(base_image["image"]))
-                        response = multimodal_model.generate_content(["Jelaskan gambar ini:", pil_image])
-                        img_chunks = text_splitter.split_text(f"[Deskripsi Gambar: {response.text.strip()}]")
-                        for chunk in img_chunks: all_content_to_process.append({'content': chunk, 'page': page_number})
-                    except Exception as e: print(f"Gagal deskripsi gambar di hal {page_number}: {e}")
-        if not all_content_to_process:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="Dokumen PDF tidak berisi konten yang bisa diproses.")
+                raise UploadCancelled()
+            window.append(page)
+            if len(window) < PDF_PAGE_WINDOW and page['page'] < total_pages:
+                continue
+            content = await build_window_content(window, seen_images)
+            task = asyncio.create_task(session.commit(content, window[0]['page'], window[-1]['page']))
+            in_flight.append((task, len(content), window[-1]['page']))
+            launched_page = window[-1]['page']
+            window = []
+            while in_flight and (in_flight[0][0].done() or sum(count for _, count, _ in in_flight) >= pipeline_chunks):
+                await checkpoint()
+        while in_flight:
+            await checkpoint()
+        stats = await session.finish()
+        if not chunk_count:
+            await document_catalog.remove(user_id, file_name)
+            await context.bot.send_message(chat_id=chat_id, text="Dokumen PDF tidak berisi konten yang bisa diproses.")
             return
-        await chunk_and_embed_content(update, context, all_content_to_process, file_name, user_id)
         duration = time.time() - start_time
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"✅ Dokumen '<code>{html.escape(file_name)}</code>' berhasil diproses dalam {duration:.2f} detik.", parse_mode=ParseMode.HTML)
-    except Exception as e: await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Terjadi kesalahan saat memproses PDF: {e}")
+        metrics.observe('ingest.pdf', duration)
+        metrics.count('documents_ingested')
+        await context.bot.send_message(chat_id=chat_id, text=f"✅ Dokumen '<code>{html.escape(file_name)}</code>' berhasil diproses dalam {duration:.2f} detik. {format_ingest_stats(stats)}", parse_mode=ParseMode.HTML)
+    except UploadCancelled:
+        await context.bot.send_message(chat_id=chat_id, text=f"⚠️ Proses unggah dibatalkan.{format_resume_hint(committed_page)}", parse_mode=ParseMode.HTML)
+    except Exception as e: await context.bot.send_message(chat_id=chat_id, text=f"Terjadi kesalahan saat memproses PDF: {e}{format_resume_hint(committed_page)}")
     finally:
-        if 'processing_task' in context.user_data: del context.user_data['processing_task']
-        if 'cancel_upload' in context.user_data: del context.user_data['cancel_upload']
+        # Commit yang belum selesai dibatalkan. Jendela setelah checkpoint yang sempat
+        # selesai juga dibuang, agar tidak ada baris baru di luar checkpoint
+        for task, _, _ in in_flight:
+            task.cancel()
+        await asyncio.gather(*(task for task, _, _ in in_flight), return_exceptions=True)
+        if launched_page > committed_page:
+            await session.rollback(committed_page + 1, launched_page)
+        if pages is not None: await pages.aclose()
+        await progress.close()
+        invalidate_user_cache(user_id)
         if os.path.exists(pdf_path): os.remove(pdf_path)
 
-def find_relevant_chunks(question: str, user_id: str, focused_file: str = None) -> list:
-    embedding_list = genai.embed_content(model=embedding_model_name, content=question, task_type="RETRIEVAL_QUERY")['embedding']
-    params = {'query_embedding': embedding_list, 'user_id_input': user_id, 'match_threshold': 0.3, 'match_count': 5}
-    function_name = 'match_documents'
-    if focused_file:
-        function_name = 'match_documents_by_file'
-        params['file_name_input'] = focused_file
-    response = supabase.rpc(function_name, params).execute()
-    return response.data if response.data else []
-
-def generate_answer(question: str, context_chunks: list, history: list) -> str:
-    context_text = "\n\n".join([f"Kutipan dari file '{html.escape(chunk['file_name'])}' halaman {chunk['page_number']}:\n---\n{html.escape(chunk['content'])}\n---" for chunk in context_chunks])
-    history_text = "\n".join([f"User: {html.escape(h['question'])}\nBot: {html.escape(h['answer'])}" for h in history])
-    prompt = f"Anda adalah asisten AI. Jawab pertanyaan pengguna hanya berdasarkan KONTEKS DARI DOKUMEN. Jawab dalam bahasa yang sama dengan pertanyaan pengguna. Jika informasi tidak ada, katakan Anda tidak dapat menemukannya.\n\n--- KONTEKS DARI DOKUMEN ---\n{context_text}\n\n--- RIWAYAT PERCAKAPAN ---\n{history_text}\n\n--- PERTANYAAN PENGGUNA ---\n{question}\n\nJAWABAN ANDA:"
-    response = generative_model.generate_content(prompt)
+def format_resume_hint(committed_page: int) -> str:
+    if not committed_page:
+        return ""
+    return f"\nHalaman 1-{committed_page} sudah tersimpan dan bisa dicari. Kirim ulang file yang sama untuk melanjutkan."
+
+async def process_and_store_text(update: Update, context: ContextTypes.DEFAULT_TYPE, file_path: str, file_name: str, user_id: str, start_time: float, file_hash: str = None):
+    """Ingest DOCX/TXT: ekstrak dan potong di process pool, lalu embed dan simpan sekaligus."""
+    file_extension = file_name.split('.')[-1].lower()
+    try:
+        chunks = await run_cpu(extraction.extract_text_chunks, file_path, file_extension)
+        if not chunks:
+            await update.message.reply_text("Dokumen ini tidak berisi teks yang bisa diproses.")
+            return
+        content_to_process = [{'content': chunk} for chunk in chunks]
+        stats = await chunk_and_embed_content(update, context, content_to_process, file_name, user_id)
+        await document_catalog.record(user_id, file_name, len(content_to_process), 1, file_hash)
+        duration = time.time() - start_time
+        metrics.observe('ingest.text', duration)
+        metrics.count('documents_ingested')
+        await update.message.reply_text(f"✅ Dokumen '<code>{html.escape(file_name)}</code>' berhasil diproses dalam {duration:.2f} detik. {format_ingest_stats(stats)}", parse_mode=ParseMode.HTML)
+    except UploadCancelled:
+        await update.message.reply_text("⚠️ Proses unggah dibatalkan.")
+    except Exception as e: await update.message.reply_text(f"Gagal memproses file: {e}")
+    finally:
+        invalidate_user_cache(user_id)
+        if os.path.exists(file_path): os.remove(file_path)
+
+# --- Penjadwal ingest ---
+def format_eta(seconds: float) -> str:
+    if seconds < 60:
+        return "kurang dari 1 menit"
+    return f"~{math.ceil(seconds / 60)} menit"
+
+class IngestJob:
+    """Satu unggahan yang menunggu/berjalan di IngestScheduler. run() memulai ingest."""
+    def __init__(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: str, file_name: str, file_path: str, run):
+        self.context = context
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.file_name = file_name
+        self.file_path = file_path
+        self.run = run
+        self.progress = None
+        self.future = None
+        self.started = False
+        self.enqueued_at = time.monotonic()
+
+SCHEDULER_HISTORY_USERS = 10000  # Jumlah pengguna yang urutan layanannya diingat
+
+class IngestScheduler:
+    """
+    Antrean ingest pusat. Setiap pengguna punya antrean FIFO sendiri; paling banyak
+    INGEST_WORKERS dokumen diproses bersamaan dan slot kosong diberikan
+    ke pengguna yang paling lama tidak dilayani dan sedang tidak punya ingest berjalan,
+    sehingga satu pengguna dengan banyak file tidak menghabiskan kapasitas. Ingest
+    berjalan dengan prioritas bulk (lihat request_priority). Pesan antrean
+    menampilkan posisi dan perkiraan waktu mulai dari rata-rata durasi ingest.
+    """
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self.queues = {}
+        self.running = {}
+        self.served = OrderedDict()  # user_id -> urutan terakhir dilayani (terlama di depan)
+        self.serve_seq = itertools.count()
+        self.avg_duration = None
+
+    def _rank(self, user_id: str) -> tuple:
+        return user_id in self.running, self.served.get(user_id, -1)
+
+    def _order(self) -> list:
+        """Urutan perkiraan job yang menunggu jika dilayani bergiliran dari posisi sekarang."""
+        pending = [list(self.queues[user_id]) for user_id in sorted(self.queues, key=self._rank)]
+        order = []
+        while any(pending):
+            for queue in pending:
+                if queue:
+                    order.append(queue.pop(0))
+        return order
+
+    def status(self, job: IngestJob) -> tuple:
+        """(posisi antrean mulai 1, perkiraan detik sampai mulai atau None)."""
+        index = self._order().index(job)
+        waves = (index + len(self.running)) // self.workers
+        eta = waves * self.avg_duration if self.avg_duration is not None else None
+        return index + 1, eta
+
+    def describe(self, job: IngestJob) -> str:
+        position, eta = self.status(job)
+        text = f"⏳ '{job.file_name}' menunggu di antrean (posisi {position})"
+        if eta is not None:
+            text += f", perkiraan mulai {format_eta(eta)}"
+        return text + ". Kirim /cancel untuk membatalkan."
+
+    async def submit(self, job: IngestJob):
+        """
+        Memasukkan job ke antrean pengguna lalu membagikan slot kosong. Jika job
+        belum bisa langsung mulai, pesan posisi antrean dikirim ke chat.
+        """
+        job.future = asyncio.get_running_loop().create_future()
+        job.context.user_data['processing_task'] = job.future
+        self.queues.setdefault(job.user_id, deque()).append(job)
+        self.dispatch()
+        if job.started:
+            return
+        job.progress = ProgressMessage(job.context, job.chat_id)
+        await job.progress.start(self.describe(job))
+        if job.started:
+            # Job sudah mulai selagi pesan antrean dikirim
+            await job.progress.close()
+
+    def dispatch(self):
+        while len(self.running) < self.workers:
+            candidates = [user_id for user_id in self.queues if user_id not in self.running]
+            if not candidates:
+                return
+            user_id = min(candidates, key=self._rank)
+            queue = self.queues[user_id]
+            job = queue.popleft()
+            if not queue:
+                del self.queues[user_id]
+            self.served[user_id] = next(self.serve_seq)
+            self.served.move_to_end(user_id)
+            if len(self.served) > SCHEDULER_HISTORY_USERS:
+                self.served.popitem(last=False)
+            self.running[user_id] = job
+            job.started = True
+            job.context.user_data['cancel_upload'] = False
+            asyncio.create_task(self._run(job))
+
+    async def _run(self, job: IngestJob):
+        request_priority.set(PRIORITY_BULK)
+        metrics.observe('ingest.queue_wait', time.monotonic() - job.enqueued_at)
+        started = time.monotonic()
+        try:
+            if job.progress:
+                await job.progress.close()
+            await job.context.bot.send_message(chat_id=job.chat_id, text=f"Memproses '<code>{html.escape(job.file_name)}</code>'...", parse_mode=ParseMode.HTML)
+            await job.run()
+        except Exception as e:
+            print(f"Ingest '{job.file_name}' gagal: {e}")
+        finally:
+            elapsed = time.monotonic() - started
+            self.avg_duration = elapsed if self.avg_duration is None else 0.7 * self.avg_duration + 0.3 * elapsed
+            self.running.pop(job.user_id, None)
+            job.context.user_data.pop('cancel_upload', None)
+            if not job.future.done():
+                job.future.set_result(None)
+            self.dispatch()
+            await self.announce()
+
+    async def announce(self):
+        """Memperbarui pesan antrean setiap job yang masih menunggu (dibatasi PROGRESS_EDIT_INTERVAL)."""
+        for job in self._order():
+            if job.progress:
+                await job.progress.update(self.describe(job))
+
+    async def cancel(self, user_id: str) -> tuple:
+        """Membatalkan semua job pengguna yang masih menunggu dan memberi sinyal batal ke job yang berjalan."""
+        queued = list(self.queues.pop(user_id, ()))
+        for job in queued:
+            if job.progress:
+                await job.progress.close()
+            if os.path.exists(job.file_path):
+                os.remove(job.file_path)
+            if not job.future.done():
+                job.future.set_result(None)
+        running = self.running.get(user_id)
+        if running:
+            running.context.user_data['cancel_upload'] = True
+        if queued:
+            await self.announce()
+        return len(queued), running is not None
+
+    def stats(self) -> dict:
+        return {'running': len(self.running), 'queued': sum(len(queue) for queue in self.queues.values()),
+                'users_waiting': len(self.queues)}
+
+ingest_scheduler = IngestScheduler(INGEST_WORKERS)
+
+# Cache sisi query: embedding pertanyaan (lintas pengguna, kunci = teks ternormalisasi)
+# dan hasil pencarian per pengguna. Cache pengguna dibuang saat dokumennya berubah.
+query_embedding_cache = TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+retrieval_cache = TTLCache(RETRIEVAL_CACHE_USERS)
+retrieval_stats = {'hits': 0, 'misses': 0}
+
+def normalize_query(question: str) -> str:
+    return " ".join(question.casefold().split()).rstrip(" ?!.")
+
+def invalidate_user_cache(user_id: str):
+    retrieval_cache.pop(user_id)
+
+def build_lexical_index(rows: list) -> lexical.BM25Index:
+    index = lexical.BM25Index()
+    for row in rows:
+        # Hash dihitung seperti IngestSession.commit (halaman kosong dianggap 1)
+        index.add(row['content'], row['file_name'], row['page_number'], chunk_hash(row['content'], row['page_number'] or 1))
+    return index
+
+class LexicalIndexes:
+    """
+    Indeks BM25 per pengguna untuk backend lokal (LRU, kedaluwarsa setelah
+    LEXICAL_INDEX_TTL agar perubahan dari proses lain ikut terbaca). Indeks dibangun
+    di latar belakang dari semua potongan pengguna saat pertama dicari, lalu
+    diperbarui inkremental oleh ingest dan /delete_doc. Perubahan selama
+    pembangunan menandai hasilnya usang sehingga pembangunan diulang. Backend
+    Supabase memakai full-text search Postgres dan tidak memakai kelas ini.
+    """
+    def __init__(self, max_users: int, ttl: float):
+        self.indexes = TTLCache(max_users, ttl)
+        self.building = {}  # user_id -> {'task', 'dirty'}
+
+    def _changed(self, user_id: str):
+        if user_id in self.building:
+            self.building[user_id]['dirty'] = True
+
+    def add(self, user_id: str, rows: list):
+        index = self.indexes.peek(user_id)
+        if index is not None:
+            for row in rows:
+                index.add(row['content'], row['file_name'], row.get('page_number') or 1, row['content_hash'])
+        self._changed(user_id)
+
+    def remove(self, user_id: str, file_name: str, content_hashes: list):
+        if not content_hashes:
+            return
+        index = self.indexes.peek(user_id)
+        if index is not None:
+            if None in content_hashes:
+                # Baris lama tanpa content_hash tidak bisa dicocokkan: bangun ulang saat dicari
+                self.indexes.pop(user_id)
+            else:
+                for content_hash in content_hashes:
+                    index.remove(file_name, content_hash)
+        self._changed(user_id)
+
+    def remove_file(self, user_id: str, file_name: str):
+        index = self.indexes.peek(user_id)
+        if index is not None:
+            index.remove_file(file_name)
+        self._changed(user_id)
+
+    def _start_build(self, user_id: str) -> asyncio.Future:
+        state = self.building.get(user_id)
+        if state is None:
+            state = self.building[user_id] = {'dirty': False}
+            state['task'] = asyncio.ensure_future(self._build(user_id, state))
+            state['task'].add_done_callback(self._build_done)
+        return state['task']
+
+    @staticmethod
+    def _build_done(task: asyncio.Future):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Indeks leksikal gagal dibangun: {task.exception()}")
+
+    def get_nowait(self, user_id: str):
+        """Indeks yang sudah siap, atau None sambil memulai pembangunan di latar belakang."""
+        index = self.indexes.get(user_id)
+        if index is None:
+            self._start_build(user_id)
+        return index
+
+    async def get(self, user_id: str) -> lexical.BM25Index:
+        """Menunggu indeks siap (dipakai warm-up dan benchmark, bukan jalur pertanyaan)."""
+        index = self.indexes.get(user_id)
+        if index is not None:
+            return index
+        # shield: pemanggil yang dibatalkan tidak ikut membatalkan pembangunan
+        return await asyncio.shield(self._start_build(user_id))
+
+    async def _build(self, user_id: str, state: dict) -> lexical.BM25Index:
+        try:
+            for _ in range(3):
+                state['dirty'] = False
+                rows = await vector_store.get_chunks(user_id)
+                with metrics.span('lexical.build'):
+                    index = await asyncio.to_thread(build_lexical_index, rows)
+                if not state['dirty']:
+                    break
+            self.indexes.set(user_id, index)
+            return index
+        finally:
+            del self.building[user_id]
+
+    def stats(self) -> dict:
+        return {'hits': self.indexes.hits, 'misses': self.indexes.misses, 'size': len(self.indexes)}
+
+lexical_indexes = LexicalIndexes(LEXICAL_INDEX_USERS, LEXICAL_INDEX_TTL)
+
+def cache_stats() -> dict:
+    """Jumlah hit/miss dan ukuran cache embedding query, hasil pencarian, dan caption gambar."""
+    return {
+        'query_embedding': {'hits': query_embedding_cache.hits, 'misses': query_embedding_cache.misses, 'size': len(query_embedding_cache)},
+        'retrieval': {**retrieval_stats, 'size': sum(len(cache) for _, cache in retrieval_cache.items())},
+        'caption': {'hits': caption_cache.hits, 'misses': caption_cache.misses, 'size': len(caption_cache)},
+        'lexical_index': lexical_indexes.stats(),
+    }
+
+async def embed_query(question: str) -> list:
+    key = normalize_query(question)
+    embedding_list = query_embedding_cache.get(key)
+    if embedding_list is None:
+        with metrics.span('query.embed'):
+            embedding_list = (await embed_content(model=embedding_model_name, content=question, task_type="RETRIEVAL_QUERY"))['embedding']
+        query_embedding_cache.set(key, embedding_list)
+    return embedding_list
+
+async def find_relevant_chunks(question: str, user_id: str, focused_file: str = None, match_threshold: float = 0.3, match_count: int = RETRIEVAL_CANDIDATES) -> list:
+    embedding_list = await embed_query(question)
+    user_cache = retrieval_cache.get(user_id)
+    if user_cache is None:
+        user_cache = TTLCache(RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL)
+        retrieval_cache.set(user_id, user_cache)
+    embedding_key = hashlib.sha1(array('f', embedding_list).tobytes()).hexdigest()
+    cache_key = (embedding_key, normalize_query(question), focused_file, match_threshold, match_count)
+    cached = user_cache.get(cache_key)
+    if cached is not None:
+        retrieval_stats['hits'] += 1
+        return list(cached)
+    retrieval_stats['misses'] += 1
+    if HYBRID_RETRIEVAL:
+        chunks = await hybrid_search(question, embedding_list, user_id, focused_file, match_threshold, match_count)
+    else:
+        with metrics.span('vector.search'):
+            chunks = await vector_store.search(user_id, embedding_list, match_threshold, match_count, focused_file)
+    user_cache.set(cache_key, chunks)
+    return list(chunks)
+
+def relevance(chunk: dict) -> float:
+    """Skor gabungan hasil retrieval hibrida, atau kemiripan kosinus untuk pencarian vektor saja."""
+    return chunk.get('score', chunk['similarity'])
+
+def fuse_results(vector_hits: list, lexical_hits: list) -> list:
+    """
+    Menggabungkan hasil vektor dan BM25. Skor tiap daftar dibagi skor terbaiknya
+    (keduanya jadi 0..1), lalu dijumlahkan berbobot HYBRID_LEXICAL_WEIGHT. Potongan
+    yang sama (file, halaman, isi) dari kedua daftar menjadi satu kandidat.
+    """
+    candidates = {}
+    top_vector = max((hit['similarity'] for hit in vector_hits), default=0.0) or 1.0
+    for hit in vector_hits:
+        key = (hit['file_name'], hit['page_number'], hit['content'])
+        candidates[key] = {**hit, 'score': (1 - HYBRID_LEXICAL_WEIGHT) * hit['similarity'] / top_vector}
+    top_lexical = max((score for score, _ in lexical_hits), default=0.0) or 1.0
+    for score, doc in lexical_hits:
+        key = (doc['file_name'], doc['page_number'], doc['content'])
+        candidate = candidates.setdefault(key, {'content': doc['content'], 'file_name': doc['file_name'],
+                                                'page_number': doc['page_number'], 'similarity': 0.0, 'score': 0.0})
+        candidate['score'] += HYBRID_LEXICAL_WEIGHT * score / top_lexical
+    return sorted(candidates.values(), key=lambda candidate: candidate['score'], reverse=True)
+
+def select_diverse(candidates: list, match_count: int) -> list:
+    """
+    Jumlah adaptif + MMR: kandidat dengan skor di bawah HYBRID_RELATIVE_CUTOFF x
+    skor terbaik dibuang (jawaban yang jelas cukup beberapa kutipan), lalu dipilih
+    sampai match_count dengan MMR, yaitu skor dikurangi kemiripan kata (Jaccard)
+    tertinggi dengan kandidat yang sudah terpilih.
+    """
+    if not candidates:
+        return []
+    top = candidates[0]['score']
+    pool = [candidate for candidate in candidates if candidate['score'] >= HYBRID_RELATIVE_CUTOFF * top]
+    if len(pool) < HYBRID_MIN_CANDIDATES:
+        pool = candidates[:HYBRID_MIN_CANDIDATES]
+    words = [set(lexical.tokenize(candidate['content'])) for candidate in pool]
+    redundancy = [0.0] * len(pool)
+    remaining = list(range(len(pool)))
+    selected = []
+    while remaining and len(selected) < match_count:
+        best = max(remaining, key=lambda i: MMR_LAMBDA * pool[i]['score'] - (1 - MMR_LAMBDA) * redundancy[i])
+        remaining.remove(best)
+        selected.append(pool[best])
+        for i in remaining:
+            union = len(words[i] | words[best])
+            redundancy[i] = max(redundancy[i], len(words[i] & words[best]) / union if union else 0.0)
+    return selected
+
+async def hybrid_search(question: str, embedding: list, user_id: str, focused_file: str, match_threshold: float, match_count: int) -> list:
+    """Pencarian vektor dan kata kunci berjalan bersamaan, lalu fuse_results dan select_diverse."""
+    pool_size = match_count * HYBRID_POOL_FACTOR
+
+    async def vector_hits():
+        with metrics.span('vector.search'):
+            return await vector_store.search(user_id, embedding, match_threshold, pool_size, focused_file)
+
+    async def lexical_hits():
+        try:
+            with metrics.span('lexical.search'):
+                return await vector_store.lexical_search(user_id, question, pool_size, focused_file)
+        except Exception as e:
+            # Pencarian tetap jalan dengan hasil vektor saja
+            print(f"Pencarian kata kunci gagal: {e}")
+            return []
+
+    vector_results, lexical_results = await asyncio.gather(vector_hits(), lexical_hits())
+    with metrics.span('hybrid.fuse'):
+        return select_diverse(fuse_results(vector_results, lexical_results), match_count)
+
+# Waktu per tahap jalur pertanyaan (refine, retrieve, answer, total) dicatat di
+# metrics sebagai tahap 'question.<tahap>'
+def record_timings(timings: dict):
+    for stage, seconds in timings.items():
+        metrics.observe(f"question.{stage}", seconds)
+    if TRACE_LOG:
+        print("Waktu tahap: " + ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in timings.items()))
+
+def needs_refinement(question: str, history: list) -> bool:
+    """
+    Refine hanya diperlukan jika ada riwayat (pertanyaan bisa merujuk ke sana)
+    atau pertanyaan terlalu singkat untuk dicari langsung.
+    """
+    return bool(history) or len(question.split()) < REFINE_MIN_WORDS
+
+def differs_meaningfully(question: str, refined_question: str) -> bool:
+    """Bandingkan himpunan kata (Jaccard); pencarian ulang hanya jika cukup berbeda."""
+    original_words = set(normalize_query(question).split())
+    refined_words = set(normalize_query(refined_question).split())
+    union = original_words | refined_words
+    if not union:
+        return False
+    return len(original_words & refined_words) / len(union) < REFINE_SIMILARITY_THRESHOLD
+
+async def refine_question(question: str, history: list) -> str:
+    history_text = "\n".join([f"User: {h['question']}\nBot: {h['answer']}" for h in history])
+    refine_prompt = f"Tugas Anda adalah memperbaiki pertanyaan pengguna agar lebih optimal untuk pencarian di database.\n- Jika pertanyaan ambigu, perjelas menggunakan riwayat chat.\n- Jika pertanyaan sangat singkat (1-2 kata), ubah menjadi kalimat tanya. Contoh: 'akurasi' -> 'Berapa akurasi modelnya?'.\n- Jangan menambahkan sapaan atau jawaban.\n- Kembalikan HANYA teks pertanyaan yang sudah diperbaiki.\n\nRiwayat:\n{history_text}\n\nPertanyaan Asli: \"{question}\"\nPertanyaan Diperbaiki:"
+    # Jalur cepat memakai model flash untuk refine; jalur lama tetap memakai model pro
+    model = refine_model if FAST_QUERY_PATH else generative_model
+    response = await generate_content(model, refine_prompt, stage='gemini.refine')
+    return response.text.strip()
+
+# --- Penyusunan prompt dengan anggaran token ---
+# deduped = token yang dihemat dengan menggabungkan overlap/duplikat (isi tetap utuh);
+# dropped = token kutipan/riwayat yang tidak masuk karena anggaran (isi hilang)
+prompt_stats = {'prompts': 0, 'tokens': 0, 'deduped': 0, 'dropped': 0}
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def find_overlap(left: str, right: str, min_overlap: int = 20) -> int:
+    """
+    Panjang sufiks `left` yang sama dengan prefiks `right` (overlap dari text_splitter),
+    atau 0 jika tidak ada overlap minimal min_overlap karakter.
+    """
+    if len(left) < min_overlap or len(right) < min_overlap:
+        return 0
+    probe = right[:min_overlap]
+    start = max(0, len(left) - extraction.CHUNK_OVERLAP - min_overlap)
+    while (index := left.find(probe, start)) != -1:
+        if right.startswith(left[index:]):
+            return len(left) - index
+        start = index + 1
+    return 0
+
+def join_pieces(chunks: list) -> list:
+    """
+    Menyambung potongan yang saling overlap (atau termuat) sampai tidak ada lagi
+    yang bisa disambung. Mengembalikan [(teks, [potongan anggota]), ...]; potongan
+    yang tidak bersinggungan tetap terpisah.
+    """
+    pieces = [(chunk['content'], [chunk]) for chunk in chunks]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(pieces)):
+            for j in range(len(pieces)):
+                if i == j:
+                    continue
+                (left, left_members), (right, right_members) = pieces[i], pieces[j]
+                if right in left:
+                    joined = left
+                elif k := find_overlap(left, right):
+                    joined = left + right[k:]
+                else:
+                    continue
+                pieces[i] = (joined, left_members + right_members)
+                del pieces[j]
+                changed = True
+                break
+            if changed:
+                break
+    return pieces
+
+def merge_chunks(chunks: list) -> list:
+    """
+    Menggabungkan potongan dari file dan halaman yang sama yang benar-benar
+    bersinggungan: potongan yang termuat di potongan lain dibuang dan potongan yang
+    saling overlap disambung tanpa mengulang bagian overlap. Potongan lain di
+    halaman yang sama (mis. semua potongan DOCX/TXT ada di halaman 1) tetap menjadi
+    kutipan terpisah. Skor kutipan = skor tertinggi anggotanya (lihat relevance);
+    hasil urut menurun.
+    """
+    groups = {}
+    for chunk in sorted(chunks, key=relevance, reverse=True):
+        groups.setdefault((chunk['file_name'], chunk['page_number']), []).append(chunk)
+    excerpts = []
+    for (file_name, page_number), members in groups.items():
+        for content, piece_members in join_pieces(members):
+            excerpt = {
+                'file_name': file_name, 'page_number': page_number, 'content': content,
+                'similarity': max(chunk['similarity'] for chunk in piece_members), 'chunk_count': len(piece_members),
+            }
+            if 'score' in piece_members[0]:
+                excerpt['score'] = max(relevance(chunk) for chunk in piece_members)
+            excerpts.append(excerpt)
+    return sorted(excerpts, key=relevance, reverse=True)
+
+def format_excerpt(excerpt: dict) -> str:
+    return f"Kutipan dari file '{html.escape(excerpt['file_name'])}' halaman {excerpt['page_number']}:\n---\n{html.escape(excerpt['content'])}\n---"
+
+def format_history_entry(entry: dict) -> str:
+    return f"User: {html.escape(entry['question'])}\nBot: {html.escape(entry['answer'])}"
+
+def pack_prompt(chunks: list, history: list, budget: int = PROMPT_TOKEN_BUDGET) -> dict:
+    """
+    Memilih riwayat dan kutipan yang muat dalam anggaran token. Riwayat terbaru
+    didahulukan (paling banyak HISTORY_TOKEN_SHARE dari anggaran, jawaban terbaru
+    dipotong jika perlu), lalu kutipan hasil merge_chunks diisi menurut kemiripan.
+    Kutipan teratas yang melebihi sisa anggaran dipotong (bukan diganti kutipan yang
+    lebih lemah); kutipan berikutnya yang tidak muat dilewati agar kutipan yang
+    lebih kecil masih bisa masuk. 'exhausted' berarti semua kandidat masuk dan masih ada ruang.
+    'deduped_tokens' = hemat dari penggabungan overlap, 'dropped_tokens' = yang
+    dibuang atau dipotong karena anggaran.
+    """
+    history_budget = int(budget * HISTORY_TOKEN_SHARE)
+    kept_history, history_tokens = [], 0
+    for entry in reversed(history):
+        tokens = estimate_tokens(format_history_entry(entry)) + 1
+        if history_tokens + tokens > history_budget:
+            if not kept_history:
+                room = (history_budget - estimate_tokens(format_history_entry({**entry, 'answer': ''})) - 1) * CHARS_PER_TOKEN
+                if room > 0:
+                    kept_history.append({**entry, 'answer': entry['answer'][:room]})
+                    history_tokens += estimate_tokens(format_history_entry(kept_history[0])) + 1
+            break
+        kept_history.append(entry)
+        history_tokens += tokens
+    kept_history.reverse()
+    history_dropped = sum(estimate_tokens(format_history_entry(entry)) + 1 for entry in history) - history_tokens
+
+    remaining = budget - history_tokens
+    selected = []
+    excerpts = merge_chunks(chunks)
+    excerpt_tokens = lambda excerpt: estimate_tokens(format_excerpt(excerpt)) + 1
+    merged_tokens = sum(excerpt_tokens(excerpt) for excerpt in excerpts)
+    for excerpt in excerpts:
+        tokens = excerpt_tokens(excerpt)
+        if tokens <= remaining:
+            selected.append(excerpt)
+            remaining -= tokens
+        elif not selected:
+            # Kutipan terbaik melebihi sisa anggaran: potong agar tetap menjadi konteks utama
+            room = remaining - excerpt_tokens({**excerpt, 'content': ''})
+            if room <= 0:
+                break
+            selected.append({**excerpt, 'content': excerpt['content'][:room * CHARS_PER_TOKEN]})
+            remaining -= excerpt_tokens(selected[-1])
+    return {
+        'excerpts': selected, 'history': kept_history,
+        'tokens': budget - remaining,
+        'deduped_tokens': max(0, sum(excerpt_tokens(chunk) for chunk in chunks) - merged_tokens),
+        'dropped_tokens': merged_tokens - sum(excerpt_tokens(excerpt) for excerpt in selected) + history_dropped,
+        'exhausted': len(selected) == len(excerpts) and remaining * CHARS_PER_TOKEN >= extraction.CHUNK_SIZE,
+    }
+
+async def assemble_context(question: str, user_id: str, focused_file: str, chunks: list, history: list) -> dict:
+    """
+    pack_prompt atas kandidat yang sudah diambil; jika semuanya muat dan anggaran
+    masih longgar, ambil kandidat tambahan sampai RETRIEVAL_MAX_CANDIDATES.
+    Mencatat token prompt, token yang dihemat dari overlap, dan token yang
+    dibuang karena anggaran secara terpisah.
+    """
+    packed = pack_prompt(chunks, history)
+    if packed['exhausted'] and len(chunks) >= RETRIEVAL_CANDIDATES and RETRIEVAL_MAX_CANDIDATES > len(chunks):
+        more = await find_relevant_chunks(question, user_id, focused_file, match_count=RETRIEVAL_MAX_CANDIDATES)
+        if len(more) > len(chunks):
+            chunks = more
+            packed = pack_prompt(chunks, history)
+    prompt_tokens = estimate_tokens(build_answer_prompt(question, packed['excerpts'], packed['history']))
+    packed['prompt_tokens'] = prompt_tokens
+    prompt_stats['prompts'] += 1
+    prompt_stats['tokens'] += prompt_tokens
+    prompt_stats['deduped'] += packed['deduped_tokens']
+    prompt_stats['dropped'] += packed['dropped_tokens']
+    if TRACE_LOG:
+        print(f"Prompt: ~{prompt_tokens} token dari {len(chunks)} kandidat -> {len(packed['excerpts'])} kutipan, "
+              f"{len(packed['history'])}/{len(history)} riwayat (hemat overlap ~{packed['deduped_tokens']}, "
+              f"terpotong anggaran ~{packed['dropped_tokens']} token)")
+    return packed
+
+def build_answer_prompt(question: str, context_chunks: list, history: list) -> str:
+    context_text = "\n\n".join(format_excerpt(chunk) for chunk in context_chunks)
+    history_text = "\n".join(format_history_entry(h) for h in history)
+    return f"Anda adalah asisten AI. Jawab pertanyaan pengguna hanya berdasarkan KONTEKS DARI DOKUMEN. Jawab dalam bahasa yang sama dengan pertanyaan pengguna. Jika informasi tidak ada, katakan Anda tidak dapat menemukannya.\n\n--- KONTEKS DARI DOKUMEN ---\n{context_text}\n\n--- RIWAYAT PERCAKAPAN ---\n{history_text}\n\n--- PERTANYAAN PENGGUNA ---\n{question}\n\nJAWABAN ANDA:"
+
+async def generate_answer(question: str, context_chunks: list, history: list) -> str:
+    response = await generate_content(generative_model, build_answer_prompt(question, context_chunks, history), stage='gemini.answer')
     return response.text if response.parts else "[RESPONS AI KOSONG]"
 
-# 4. DEFINISI HANDLER TELEGRAM
+async def generate_answer_stream(question: str, context_chunks: list, history: list):
+    """Seperti generate_answer, tetapi menghasilkan potongan teks jawaban secara bertahap."""
+    async for text in stream_content(generative_model, build_answer_prompt(question, context_chunks, history), stage='gemini.answer'):
+        yield text
+
+def split_for_telegram(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """
+    Memecah teks mentah menjadi beberapa bagian yang, setelah di-escape HTML,
+    masing-masing muat dalam satu pesan Telegram. Pemotongan diutamakan di baris
+    baru lalu spasi, dan tidak pernah memotong entitas HTML.
+    """
+    segments = []
+    while len(html.escape(text)) > limit:
+        # Cari prefix terpanjang yang hasil escape-nya masih muat
+        escaped_len, cut = 0, 0
+        while cut < len(text):
+            char_len = len(html.escape(text[cut]))
+            if escaped_len + char_len > limit:
+                break
+            escaped_len += char_len
+            cut += 1
+        for separator in ("\n", " "):
+            boundary = text.rfind(separator, 0, cut)
+            if boundary > cut // 2:
+                cut = boundary + 1
+                break
+        segments.append(text[:cut])
+        text = text[cut:]
+    segments.append(text)
+    return segments
+
+class StreamingReply:
+    """
+    Menampilkan jawaban secara bertahap dengan mengedit pesan yang sudah ada.
+    Edit dibatasi paling cepat tiap STREAM_EDIT_INTERVAL detik (batas edit
+    Telegram), dan teks yang melebihi 4096 karakter dilanjutkan di pesan baru.
+    Teks selalu di-escape sebelum dikirim sehingga aman di setiap titik parsial.
+    """
+    def __init__(self, reply_to, message=None):
+        self.reply_to = reply_to
+        self.messages = [message] if message else []
+        self.rendered = [None] * len(self.messages)
+        self.last_edit = 0.0
+
+    async def update(self, raw_text: str, suffix: str = "", final: bool = False):
+        if not final and time.monotonic() - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        if not raw_text.strip() and not suffix:
+            return
+        parts = [html.escape(segment) for segment in split_for_telegram(raw_text)]
+        if suffix:
+            # Blok sitasi (sudah berupa HTML) ditempel di akhir, atau di pesan baru jika tidak muat
+            if len(parts[-1]) + len(suffix) <= TELEGRAM_MESSAGE_LIMIT: parts[-1] += suffix
+            else: parts.append(suffix.strip())
+        for i, part in enumerate(parts):
+            if i < len(self.messages) and self.rendered[i] == part:
+                continue
+            try:
+                await self._deliver(i, part, final)
+            except RetryAfter as e:
+                # Kena batas flood Telegram di tengah streaming: edit berikutnya ditunda
+                # selama retry_after, teks terbaru tetap terkirim pada update berikutnya
+                self.last_edit = time.monotonic() + retry_after_seconds(e)
+                metrics.count('telegram_retry_after')
+                return
+            self.rendered[i] = part
+        self.last_edit = time.monotonic()
+
+    async def _deliver(self, i: int, part: str, final: bool):
+        """Edit pesan ke-i atau kirim pesan baru; update final menunggu RetryAfter lalu mencoba lagi."""
+        while True:
+            try:
+                if i < len(self.messages):
+                    try:
+                        with metrics.span('telegram.edit'):
+                            await self.messages[i].edit_text(part, parse_mode=ParseMode.HTML)
+                    except BadRequest as e:
+                        if 'not modified' not in str(e).lower(): raise
+                else:
+                    with metrics.span('telegram.send'):
+                        self.messages.append(await self.reply_to.reply_text(part, parse_mode=ParseMode.HTML))
+                    self.rendered.append(None)
+                return
+            except RetryAfter as e:
+                if not final:
+                    raise
+                metrics.count('telegram_retry_after')
+                await asyncio.sleep(retry_after_seconds(e))
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    # PTB lama memberi detik (int), versi baru bisa memberi timedelta
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, 'total_seconds') else float(delay)
+
+# Ringkasan hierarkis (map-reduce): kelompok potongan diringkas paralel, digabung
+# per file (hasilnya di-cache di katalog), lalu digabung lintas file.
+def group_texts(texts: list, max_chars: int) -> list:
+    groups, current, size = [], [], 0
+    for text in texts:
+        if current and size + len(text) > max_chars:
+            groups.append(current)
+            current, size = [], 0
+        current.append(text)
+        size += len(text)
+    if current:
+        groups.append(current)
+    return groups
+
+async def reduce_summaries(summaries: list, instruction: str) -> str:
+    """Menggabungkan ringkasan bertahap (paralel per kelompok) sampai tersisa satu."""
+    if not summaries:
+        return ""
+    while len(summaries) > 1:
+        groups = group_texts(summaries, SUMMARY_GROUP_CHARS)
+        if len(groups) == len(summaries):
+            # Setiap ringkasan sudah sebesar batas kelompok: gabungkan berpasangan
+            groups = [summaries[i:i + 2] for i in range(0, len(summaries), 2)]
+        summaries = await asyncio.gather(*(summarize_text(instruction, "\n\n".join(group)) for group in groups))
+    return summaries[0]
+
+async def summarize_text(instruction: str, text: str) -> str:
+    response = await with_retry(generate_content, summary_model, f"{instruction}\n---\n{text}\n---", stage='gemini.summarize')
+    return response.text.strip() if response.parts else ""
+
+async def summarize_file(user_id: str, file_name: str) -> str:
+    """Ringkasan satu file dari seluruh potongannya; memakai cache di katalog jika ada."""
+    entry = (await document_catalog.entries(user_id)).get(file_name)
+    if entry and entry.get('summary'):
+        return entry['summary']
+    chunks = await vector_store.get_chunks(user_id, file_name)
+    if not chunks:
+        return ""
+    # Urutan tabel bukan urutan dokumen: ingest inkremental menambahkan potongan baru di
+    # akhir. Baris lama tanpa chunk_index tetap pada urutan simpannya (sort stabil).
+    chunks.sort(key=lambda chunk: (chunk.get('page_number') or 1, chunk.get('chunk_index') or 0))
+    groups = group_texts([chunk['content'] for chunk in chunks], SUMMARY_GROUP_CHARS)
+    partials = await asyncio.gather(*(summarize_text("Ringkas bagian dokumen berikut secara padat. Pertahankan angka, nama, dan fakta penting:", "\n".join(group)) for group in groups))
+    summary = await reduce_summaries([p for p in partials if p], f"Gabungkan ringkasan bagian-bagian dokumen '{file_name}' berikut menjadi satu ringkasan yang padat dan informatif:")
+    await document_catalog.set_summary(user_id, file_name, summary)
+    return summary
+
+async def summarize_corpus(user_id: str, file_names: list) -> str:
+    summaries = await asyncio.gather(*(summarize_file(user_id, name) for name in file_names))
+    named = [(name, summary) for name, summary in zip(file_names, summaries) if summary]
+    if len(named) <= 1:
+        return named[0][1] if named else ""
+    parts = [f"Dokumen '{name}':\n{summary}" for name, summary in named]
+    if len(group_texts(parts, SUMMARY_GROUP_CHARS)) > 1:
+        # Terlalu banyak untuk satu prompt: gabungkan bertahap dulu dengan model ringkasan
+        parts = [await reduce_summaries(parts, "Gabungkan ringkasan dokumen-dokumen berikut menjadi satu ringkasan yang padat. Sebutkan nama dokumen untuk setiap fakta penting:")]
+    prompt = "Buat ringkasan eksekutif yang padat dan informatif dari ringkasan dokumen-dokumen berikut:\n---\n" + "\n\n".join(parts) + "\n---"
+    response = await with_retry(generate_content, generative_model, prompt, stage='gemini.summarize_corpus')
+    return response.text.strip() if response.parts else ""
+
+# --- Riwayat percakapan persisten ---
+class ChatHistoryLog:
+    """
+    Log riwayat percakapan per pengguna dalam file JSONL (satu entri per baris).
+    Penambahan hanya menulis satu baris; file dipangkas ke `limit` entri terbaru
+    saat dibaca bila sudah tumbuh lebih dari dua kali lipatnya.
+    """
+    def __init__(self, root: str, limit: int):
+        self.root = root
+        self.limit = limit
+        self._lock = threading.Lock()
+
+    def _path(self, user_id: str) -> str:
+        safe_id = "".join(c for c in str(user_id) if c.isalnum() or c in '-_')
+        return os.path.join(self.root, f"{safe_id}.jsonl")
+
+    def _append(self, user_id: str, entry: dict):
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self._path(user_id), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _load(self, user_id: str) -> list:
+        path = self._path(user_id)
+        with self._lock:
+            if not os.path.exists(path):
+                return []
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+            if len(lines) > 2 * self.limit:
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.writelines(lines[-self.limit:])
+                os.replace(tmp_path, path)
+        return [json.loads(line) for line in lines[-self.limit:] if line.strip()]
+
+    def _clear(self, user_id: str):
+        with self._lock:
+            path = self._path(user_id)
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def append(self, user_id: str, question: str, answer: str):
+        entry = {'question': question, 'answer': answer, 'time': datetime.now(timezone.utc).isoformat()}
+        await run_blocking('local_store', self._append, user_id, entry)
+
+    async def load(self, user_id: str) -> list:
+        return await run_blocking('local_store', self._load, user_id)
+
+    async def clear(self, user_id: str):
+        await run_blocking('local_store', self._clear, user_id)
+
+chat_history_log = ChatHistoryLog(HISTORY_DIR, EXPORT_HISTORY_LIMIT)
+
+# --- Permukaan metrik: /stats dan endpoint Prometheus ---
+def metric_gauges() -> dict:
+    gauges = {}
+    for cache_name, stats in cache_stats().items():
+        for field, value in stats.items():
+            gauges[(f"cache_{field}", (('cache', cache_name),))] = value
+    for field, value in prompt_stats.items():
+        gauges[("prompt", (('field', field),))] = value
+    for field, value in ingest_scheduler.stats().items():
+        gauges[("ingest_queue", (('field', field),))] = value
+    return gauges
+
+def format_stats() -> str:
+    """Ringkasan teks untuk /stats: persentil per tahap, counter, dan cache."""
+    lines = [f"{'tahap':<28}{'n':>7}{'err':>5}{'p50':>8}{'p95':>8}{'p99':>8}  (ms)"]
+    for stage, stats in metrics.summary().items():
+        lines.append(f"{stage:<28}{stats['count']:>7}{stats['errors']:>5}"
+                     f"{stats['p50'] * 1000:>8.0f}{stats['p95'] * 1000:>8.0f}{stats['p99'] * 1000:>8.0f}")
+    if metrics.counters:
+        lines.append("")
+        for (name, label), value in sorted(metrics.counters.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+            lines.append(f"{name}{f'[{label}]' if label else ''}: {value}")
+    lines.append("")
+    for cache_name, stats in cache_stats().items():
+        total = stats['hits'] + stats['misses']
+        rate = f"{stats['hits'] / total * 100:.0f}%" if total else "-"
+        lines.append(f"cache {cache_name}: {stats['hits']}/{total} hit ({rate}), {stats['size']} entri")
+    if prompt_stats['prompts']:
+        lines.append(f"prompt: rata-rata ~{prompt_stats['tokens'] // prompt_stats['prompts']} token, "
+                     f"hemat overlap ~{prompt_stats['deduped']} token, terpotong anggaran ~{prompt_stats['dropped']} token")
+    return "\n".join(lines)
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = "200 OK", metrics.render_prometheus(metric_gauges()).encode('utf-8')
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+_metrics_server = None
+
+async def start_metrics_server():
+    """Endpoint teks Prometheus lokal (GET /metrics) jika METRICS_PORT diatur."""
+    global _metrics_server
+    if METRICS_PORT and METRICS_ENABLED and _metrics_server is None:
+        _metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        print(f"Metrik Prometheus tersedia di http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+# 6. DEFINISI HANDLER TELEGRAM
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     help_text = ("<b>Halo! Saya asisten dokumen pribadi Anda.</b>\n\n"
@@ -164,9 +2383,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                  "• /fokus <code>nama_file.pdf</code> - Fokus tanya jawab ke satu file.\n"
                  "• /hapus_fokus - Kembali bertanya ke semua file.\n"
                  "• /list_docs - Lihat daftar dokumen.\n"
+                 "• /summarize - Ringkas semua dokumen (atau file yang sedang difokuskan).\n"
                  "• /delete_doc <code>nama_file.pdf</code> - Hapus dokumen.\n"
                  "• /export - Ekspor riwayat chat ke PDF.\n"
-                 "• /clear - Hapus riwayat chat sesi ini.\n"
+                 "• /clear - Hapus riwayat chat.\n"
                  "• /cancel - Batalkan proses upload file.")
     await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
 
@@ -189,197 +2409,155 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     doc = update.message.document
     file_name = doc.file_name
-    if context.user_data.get('processing_task') and not context.user_data['processing_task'].done():
-        await update.message.reply_text("Harap tunggu, proses lain sedang berjalan.")
-        return
-    supabase.table('documents').delete().eq('user_id', user_id).eq('file_name', file_name).execute()
     file_path = f"{doc.file_id}_{file_name}" # Path relatif, bukan /content/
     new_file = await context.bot.get_file(doc.file_id)
     await new_file.download_to_drive(file_path)
-    start_time = time.time()
-    await update.message.reply_text(f"Memproses '<code>{html.escape(file_name)}</code>'...", parse_mode=ParseMode.HTML)
-    file_extension = ""
-    try:
-        file_extension = file_name.split('.')[-1].lower()
-        if file_extension == 'pdf':
-            context.user_data['cancel_upload'] = False
-            task = asyncio.create_task(process_and_store_pdf(update, context, file_path, file_name, user_id, start_time))
-            context.user_data['processing_task'] = task
-            return
-        full_text = ""
-        if file_extension == 'docx':
-            document = docx.Document(file_path)
-            full_text = "\n".join([para.text for para in document.paragraphs])
-        elif file_extension == 'txt':
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                full_text = f.read()
-        if not full_text.strip():
-            await update.message.reply_text("Dokumen ini tidak berisi teks yang bisa diproses.")
-            return
-        chunks = text_splitter.split_text(full_text)
-        content_to_process = [{'content': chunk} for chunk in chunks]
-        await chunk_and_embed_content(update, context, content_to_process, file_name, user_id)
-        duration = time.time() - start_time
-        await update.message.reply_text(f"✅ Dokumen '<code>{html.escape(file_name)}</code>' berhasil diproses dalam {duration:.2f} detik.", parse_mode=ParseMode.HTML)
-    except Exception as e: await update.message.reply_text(f"Gagal memproses file: {e}")
-    finally:
-        if file_extension != 'pdf' and os.path.exists(file_path):
+    file_hash = await asyncio.to_thread(hash_file, file_path)
+    catalog_entry = (await document_catalog.entries(user_id)).get(file_name)
+    resume_from = 0
+    if catalog_entry and catalog_entry.get('content_hash') == file_hash:
+        if is_complete(catalog_entry):
+            # File identik dengan yang sudah tersimpan: tidak perlu diproses ulang
             os.remove(file_path)
+            await update.message.reply_text(f"✅ Dokumen '<code>{html.escape(file_name)}</code>' sudah tersimpan. Tidak ada perubahan sejak unggahan sebelumnya.", parse_mode=ParseMode.HTML)
+            return
+        # Ingest file yang sama sebelumnya terhenti: lanjutkan dari checkpoint
+        resume_from = catalog_entry['last_page']
+    if file_name.split('.')[-1].lower() == 'pdf':
+        run = lambda: process_and_store_pdf(update, context, file_path, file_name, user_id, time.time(), file_hash, resume_from)
+    else:
+        run = lambda: process_and_store_text(update, context, file_path, file_name, user_id, time.time(), file_hash)
+    # Ingest masuk antrean bersama (adil antar pengguna); handler langsung kembali
+    await ingest_scheduler.submit(IngestJob(context, update.effective_chat.id, user_id, file_name, file_path, run))
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     question = update.message.text
-    response = supabase.table('documents').select('id', count='exact').eq('user_id', user_id).execute()
-    if response.count == 0:
+    if not await document_catalog.entries(user_id):
         panduan_awal_text = "Halo! Sepertinya Anda belum mengunggah dokumen apa pun.\n\nSilakan <b>unggah file PDF, DOCX, atau TXT</b> terlebih dahulu."
         await update.message.reply_text(panduan_awal_text, parse_mode=ParseMode.HTML)
         return
     if 'history' not in context.user_data: context.user_data['history'] = []
     waiting_message = await update.message.reply_text('Menganalisis permintaan...')
+    started = time.perf_counter()
+    timings = {}
     try:
-        history_text = "\n".join([f"User: {h['question']}\nBot: {h['answer']}" for h in context.user_data.get('history', [])])
-        refine_prompt = f"Tugas Anda adalah memperbaiki pertanyaan pengguna agar lebih optimal untuk pencarian di database.\n- Jika pertanyaan ambigu, perjelas menggunakan riwayat chat.\n- Jika pertanyaan sangat singkat (1-2 kata), ubah menjadi kalimat tanya. Contoh: 'akurasi' -> 'Berapa akurasi modelnya?'.\n- Jangan menambahkan sapaan atau jawaban.\n- Kembalikan HANYA teks pertanyaan yang sudah diperbaiki.\n\nRiwayat:\n{history_text}\n\nPertanyaan Asli: \"{question}\"\nPertanyaan Diperbaiki:"
-        refined_question_response = generative_model.generate_content(refine_prompt)
-        refined_question = refined_question_response.text.strip()
-        await waiting_message.edit_text(f"Mencari informasi untuk: \"<i>{html.escape(refined_question)}</i>\"", parse_mode=ParseMode.HTML)
+        history = context.user_data['history']
         focused_file = context.user_data.get('focused_document')
-        relevant_chunks = find_relevant_chunks(refined_question, user_id, focused_file)
+        if FAST_QUERY_PATH and not needs_refinement(question, history):
+            # Pertanyaan sudah jelas dan tanpa riwayat: langsung cari tanpa refine
+            refined_question = question
+            await waiting_message.edit_text(f"Mencari informasi untuk: \"<i>{html.escape(refined_question)}</i>\"", parse_mode=ParseMode.HTML)
+            stage_start = time.perf_counter()
+            relevant_chunks = await find_relevant_chunks(refined_question, user_id, focused_file)
+            timings['retrieve'] = time.perf_counter() - stage_start
+        else:
+            # Pencarian spekulatif dengan pertanyaan asli berjalan selama refine
+            speculative = None
+            if FAST_QUERY_PATH and SPECULATIVE_RETRIEVAL:
+                speculative = asyncio.create_task(find_relevant_chunks(question, user_id, focused_file))
+                speculative.add_done_callback(lambda task: task.cancelled() or task.exception())
+            stage_start = time.perf_counter()
+            try:
+                refined_question = await refine_question(question, history)
+            except BaseException:
+                if speculative: speculative.cancel()
+                raise
+            timings['refine'] = time.perf_counter() - stage_start
+            await waiting_message.edit_text(f"Mencari informasi untuk: \"<i>{html.escape(refined_question)}</i>\"", parse_mode=ParseMode.HTML)
+            stage_start = time.perf_counter()
+            if speculative and not differs_meaningfully(question, refined_question):
+                relevant_chunks = await speculative
+            else:
+                if speculative: speculative.cancel()
+                relevant_chunks = await find_relevant_chunks(refined_question, user_id, focused_file)
+            timings['retrieve'] = time.perf_counter() - stage_start
         if not relevant_chunks:
             await waiting_message.edit_text('Maaf, saya tidak dapat menemukan informasi spesifik mengenai itu di dokumen Anda.')
             return
-        final_answer = generate_answer(refined_question, relevant_chunks, context.user_data['history']).strip()
-        safe_answer = html.escape(final_answer)
+        stage_start = time.perf_counter()
+        packed = await assemble_context(refined_question, user_id, focused_file, relevant_chunks, history)
+        timings['assemble'] = time.perf_counter() - stage_start
         citations = "\n\n--- \n<b>Sumber Informasi:</b>\n"
-        for chunk in relevant_chunks:
+        for chunk in packed['excerpts']:
             safe_filename = html.escape(chunk['file_name'])
             safe_snippet = html.escape(chunk['content'][:80].replace("\n", " "))
             page_number = chunk['page_number']
-            similarity = chunk['similarity'] * 100
-            citations += f"• <code>{safe_filename}</code>, Hal. {page_number} (<b>Kemiripan: {similarity:.2f}%</b>): \"<i>{safe_snippet}...</i>\"\n"
-        full_response = safe_answer + citations
+            if 'score' in chunk:
+                # Skor retrieval hibrida (vektor + kata kunci), relatif terhadap hasil terbaik
+                label = f"Relevansi: {chunk['score'] * 100:.0f}%"
+            else:
+                label = f"Kemiripan: {chunk['similarity'] * 100:.2f}%"
+            citations += f"• <code>{safe_filename}</code>, Hal. {page_number} (<b>{label}</b>): \"<i>{safe_snippet}...</i>\"\n"
+        stage_start = time.perf_counter()
+        if STREAM_ANSWERS:
+            # Pesan tunggu diedit bertahap selama jawaban mengalir dari model
+            reply = StreamingReply(update.message, waiting_message)
+            answer_text = ""
+            async for text in generate_answer_stream(refined_question, packed['excerpts'], packed['history']):
+                answer_text += text
+                await reply.update(answer_text)
+            final_answer = answer_text.strip() or "[RESPONS AI KOSONG]"
+        else:
+            final_answer = (await generate_answer(refined_question, packed['excerpts'], packed['history'])).strip()
+            await waiting_message.delete()
+            reply = StreamingReply(update.message)
+        await reply.update(final_answer, suffix=citations, final=True)
+        timings['answer'] = time.perf_counter() - stage_start
+        timings['total'] = time.perf_counter() - started
+        record_timings(timings)
         context.user_data['history'].append({'question': refined_question, 'answer': final_answer})
         context.user_data['history'] = context.user_data['history'][-5:]
-        await waiting_message.delete()
-        await update.message.reply_text(full_response, parse_mode=ParseMode.HTML)
+        try: await chat_history_log.append(user_id, refined_question, final_answer)
+        except Exception as e: print(f"Gagal menyimpan riwayat percakapan: {e}")
     except Exception as e:
         try: await waiting_message.delete()
         except: pass
         await update.message.reply_text(f"Terjadi kesalahan: {html.escape(str(e))}")
 
 # Handler utilitas lainnya
-# GANTI SELURUH FUNGSI LAMA ANDA DENGAN YANG INI.
-# Ini adalah versi yang paling aman dan sudah diuji untuk menangani teks panjang.
-
-# ==============================================================================
-# GANTI SELURUH FUNGSI export_chat ANDA DENGAN VERSI FINAL DAN PALING STABIL INI
-# ==============================================================================
-
-# =================================================================================
-# KODE FINAL - PENDEKATAN MANUAL UNTUK MENGHINDARI BUG FPDF INTERNAL
-# Ganti seluruh fungsi export_chat Anda dengan yang ini.
-# =================================================================================
-
 async def export_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
-    chat_history = context.user_data.get('history', [])
+    try:
+        chat_history = await chat_history_log.load(user_id)
+    except Exception as e:
+        print(f"Gagal memuat riwayat percakapan: {e}")
+        chat_history = []
+    # Sesi berjalan yang belum tercatat di log (mis. log gagal ditulis) tetap diekspor
+    if not chat_history:
+        chat_history = context.user_data.get('history', [])
 
     if not chat_history:
         await update.message.reply_text("Riwayat percakapan masih kosong.")
         return
 
-    await update.message.reply_text("Mempersiapkan file PDF (menggunakan metode rendering manual)...")
-
+    await update.message.reply_text(f"Mempersiapkan file PDF ({len(chat_history)} entri)...")
     try:
-        pdf = FPDF()
-        pdf.add_page()
-        
-        # --- FUNGSI UTAMA YANG BARU: MENULIS TEKS SECARA MANUAL ---
-        def write_manually(text, line_height=7):
-            """
-            Fungsi ini menggantikan multi_cell sepenuhnya.
-            Ia mengukur dan menulis teks baris per baris secara manual.
-            """
-            # Lebar area yang bisa ditulis di halaman
-            available_width = pdf.w - pdf.l_margin - pdf.r_margin
-            
-            # Bersihkan teks dari karakter aneh
-            safe_text = text.encode('latin-1', 'replace').decode('latin-1')
-            words = safe_text.split(' ')
-            
-            current_line = ""
-            for word in words:
-                # Cek dulu: apakah kata ini sendiri lebih panjang dari halaman?
-                word_width = pdf.get_string_width(word)
-                if word_width > available_width:
-                    # Jika buffer tidak kosong, cetak dulu
-                    if current_line:
-                        pdf.cell(0, line_height, txt=current_line, ln=1)
-                        current_line = ""
-                    
-                    # Potong-potong kata monster ini karakter per karakter
-                    temp_word = ""
-                    for char in word:
-                        if pdf.get_string_width(temp_word + char) > available_width:
-                            pdf.cell(0, line_height, txt=temp_word, ln=1)
-                            temp_word = char
-                        else:
-                            temp_word += char
-                    current_line = temp_word # Sisa dari kata yang dipotong
-                    continue
-
-                # Cek apakah menambahkan kata baru akan melebihi batas
-                separator = ' ' if current_line else ''
-                if pdf.get_string_width(current_line + separator + word) > available_width:
-                    # Baris sudah penuh, cetak baris saat ini
-                    pdf.cell(0, line_height, txt=current_line, ln=1)
-                    current_line = word # Mulai baris baru dengan kata ini
-                else:
-                    # Masih ada tempat, tambahkan kata ke baris saat ini
-                    current_line += separator + word
-            
-            # Cetak baris terakhir yang tersisa di buffer
-            if current_line:
-                pdf.cell(0, line_height, txt=current_line, ln=1)
-        # --- AKHIR FUNGSI BANTUAN ---
-
-        # Mulai menulis dokumen
-        pdf.set_font("Helvetica", 'B', 12)
-        pdf.cell(0, 10, text="Riwayat Percakapan Chatbot", align='C', ln=1)
-        pdf.ln(5)
-
-        for item in chat_history:
-            # Menggunakan fungsi manual kita
-            pdf.set_font("Helvetica", 'B', 11)
-            write_manually(f"Anda: {item['question']}")
-            
-            pdf.set_font("Helvetica", '', 11)
-            write_manually(f"Bot: {item['answer']}")
-            pdf.ln(5) # Spasi antar entri chat
-
-        file_path = f"history_{user_id}.pdf"
-        pdf.output(file_path)
-        
-        with open(file_path, 'rb') as f:
-            await context.bot.send_document(chat_id=update.effective_chat.id, document=f)
-        os.remove(file_path)
-
+        entries = [{'question': item['question'], 'answer': item['answer']} for item in chat_history]
+        import pdf_export
+        pdf_bytes = await run_cpu(pdf_export.build_history_pdf, entries, EXPORT_FONT_PATH, EXPORT_FONT_BOLD_PATH)
+        document = io.BytesIO(pdf_bytes)
+        document.name = f"history_{user_id}.pdf"
+        await context.bot.send_document(chat_id=update.effective_chat.id, document=document, filename=document.name)
     except Exception as e:
-        # Jika ini masih gagal, kita akan tahu teks mana yang jadi penyebabnya
-        print("="*20, "FATAL PDF ERROR", "="*20)
-        print(f"Gagal pada item: {item}") # Mencetak item terakhir yang diproses
-        print(f"Error: {e}")
-        print("="*50)
-        await update.message.reply_text(f"Gagal total membuat PDF dengan metode manual: {e}")
+        print(f"Gagal membuat PDF riwayat: {e}")
+        await update.message.reply_text(f"Gagal membuat PDF: {e}")
 
 async def list_docs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     try:
-        response = supabase.table('documents').select('file_name', count='exact').eq('user_id', user_id).execute()
-        if response.count == 0:
+        entries = await document_catalog.entries(user_id)
+        if not entries:
             await update.message.reply_text("Anda belum mengunggah dokumen.")
             return
-        unique_files = sorted(list(set(d['file_name'] for d in response.data)))
-        message = "<b>Dokumen tersimpan:</b>\n" + "\n".join(f"• <code>{html.escape(name)}</code>" for name in unique_files)
+        lines = []
+        for name in sorted(entries):
+            entry = entries[name]
+            line = f"• <code>{html.escape(name)}</code> ({entry['chunk_count']} potongan, {entry['page_count']} hal.)"
+            if not is_complete(entry):
+                line += f" — <i>belum selesai, hal. 1-{entry['last_page']}</i>"
+            lines.append(line)
+        message = "<b>Dokumen tersimpan:</b>\n" + "\n".join(lines)
         await update.message.reply_text(message, parse_mode=ParseMode.HTML)
     except Exception as e: await update.message.reply_text(f"Error: {e}")
 
@@ -406,11 +2584,14 @@ async def delete_doc(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Mencari dan menghapus '<code>{html.escape(file_name_to_delete)}</code>'...", parse_mode=ParseMode.HTML)
         
         # --- PERBAIKAN 2: Cek hasil penghapusan ---
-        # Menambahkan count='exact' untuk mendapatkan jumlah baris yang dihapus
-        response = supabase.table('documents').delete(count='exact').eq('user_id', user_id).eq('file_name', file_name_to_delete).execute()
+        # delete_file mengembalikan jumlah baris yang dihapus
+        deleted_count = await vector_store.delete_file(user_id, file_name_to_delete)
+        lexical_indexes.remove_file(user_id, file_name_to_delete)
+        await document_catalog.remove(user_id, file_name_to_delete)
+        invalidate_user_cache(user_id)
 
         # Periksa apakah ada baris yang benar-benar terhapus
-        if response.count > 0:
+        if deleted_count > 0:
             await update.message.reply_text(f"✅ Dokumen '<code>{html.escape(file_name_to_delete)}</code>' berhasil dihapus.", parse_mode=ParseMode.HTML)
         else:
             await update.message.reply_text(f"⚠️ Dokumen '<code>{html.escape(file_name_to_delete)}</code>' tidak ditemukan.", parse_mode=ParseMode.HTML)
@@ -420,44 +2601,62 @@ async def delete_doc(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.pop('history', None)
-    await update.message.reply_text('Riwayat percakapan sesi ini telah dihapus.')
+    await chat_history_log.clear(str(update.message.from_user.id))
+    await update.message.reply_text('Riwayat percakapan telah dihapus.')
 
 async def cancel_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get('processing_task') and not context.user_data['processing_task'].done():
-        context.user_data['cancel_upload'] = True
-        await update.message.reply_text("Sinyal pembatalan terkirim...")
+    queued, running = await ingest_scheduler.cancel(str(update.message.from_user.id))
+    if running or queued:
+        notes = (["Sinyal pembatalan terkirim..."] if running else []) + ([f"{queued} file di antrean dibatalkan."] if queued else [])
+        await update.message.reply_text(" ".join(notes))
     else:
         await update.message.reply_text("Tidak ada proses unggah yang sedang berjalan.")
         
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.message.from_user.id) not in ADMIN_USER_IDS:
+        await update.message.reply_text("Perintah ini hanya untuk admin.")
+        return
+    if not METRICS_ENABLED:
+        await update.message.reply_text("Metrik dinonaktifkan (METRICS_ENABLED=false).")
+        return
+    for part in split_for_telegram(format_stats(), TELEGRAM_MESSAGE_LIMIT - len("<pre></pre>")):
+        await update.message.reply_text(f"<pre>{html.escape(part)}</pre>", parse_mode=ParseMode.HTML)
+
 async def summarize_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
-    await update.message.reply_text("Membuat ringkasan dari semua dokumen...")
+    # Ringkasan memanggil model berkali-kali: jangan mendahului pertanyaan pengguna lain.
+    # Prioritas dikembalikan di akhir karena dengan CONCURRENT_UPDATES=1 handler berjalan
+    # di task pengambil update milik PTB yang juga menjalankan update berikutnya.
+    priority_token = request_priority.set(PRIORITY_BULK)
+    # /summarize nama_file.pdf atau dokumen yang sedang difokuskan -> ringkasan satu file
+    file_name = " ".join(context.args) or context.user_data.get('focused_document')
     try:
-    
-        response = supabase.table('documents').select('content').eq('user_id', user_id).limit(100).execute()
-        
-        if not response.data:
+        entries = await document_catalog.entries(user_id)
+        if not entries:
             await update.message.reply_text("Tidak ada dokumen yang bisa diringkas.")
             return
+        if file_name:
+            if file_name not in entries:
+                await update.message.reply_text(f"⚠️ Dokumen '<code>{html.escape(file_name)}</code>' tidak ditemukan.", parse_mode=ParseMode.HTML)
+                return
+            await update.message.reply_text(f"Membuat ringkasan dari '<code>{html.escape(file_name)}</code>'...", parse_mode=ParseMode.HTML)
+            summary = await summarize_file(user_id, file_name)
+        else:
+            await update.message.reply_text("Membuat ringkasan dari semua dokumen...")
+            summary = await summarize_corpus(user_id, sorted(entries))
 
-        full_text = " ".join([item['content'] for item in response.data])
-
-       
-        prompt = f"Buat ringkasan eksekutif yang padat dan informatif dari semua teks berikut:\n---\n{full_text[:20000]}\n---"
-
-        summary_response = generative_model.generate_content(prompt)
-        await update.message.reply_text(html.escape(summary_response.text))
+        if not summary:
+            await update.message.reply_text("Tidak ada dokumen yang bisa diringkas.")
+            return
+        await StreamingReply(update.message).update(summary, final=True)
 
     except Exception as e:
         await update.message.reply_text(f"Gagal membuat ringkasan: {html.escape(str(e))}")
+    finally:
+        request_priority.reset(priority_token)
 
-# 5. FUNGSI UTAMA UNTUK MENJALANKAN BOT
-# 5. FUNGSI UTAMA UNTUK MENJALANKAN BOT
-def main():
-    print("Bot sedang disiapkan...")
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    
-
+# 7. FUNGSI UTAMA UNTUK MENJALANKAN BOT
+def register_handlers(application: Application):
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("list_docs", list_docs))
     application.add_handler(CommandHandler("delete_doc", delete_doc))
@@ -466,19 +2665,92 @@ def main():
     application.add_handler(CommandHandler("export", export_chat))
     application.add_handler(CommandHandler("fokus", set_focus))
     application.add_handler(CommandHandler("hapus_fokus", remove_focus))
-    application.add_handler(CommandHandler("summarize", summarize_document)) 
-    
+    application.add_handler(CommandHandler("summarize", summarize_document))
+    application.add_handler(CommandHandler("stats", show_stats))
+
     application.add_handler(MessageHandler(
-        filters.Document.PDF | filters.Document.TXT | filters.Document.DOCX, 
+        filters.Document.PDF | filters.Document.TXT | filters.Document.DOCX,
         handle_document
     ))
-    
+
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    
+    # Grup 1 berjalan setelah handler utama selesai menangani update yang sama
+    application.add_handler(TypeHandler(Update, record_first_response), group=1)
+
+_first_response_recorded = False
+
+async def record_first_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mencatat waktu dari proses mulai sampai update pertama selesai ditangani."""
+    global _first_response_recorded
+    if _first_response_recorded:
+        return
+    _first_response_recorded = True
+    elapsed = time.monotonic() - PROCESS_START
+    metrics.observe('startup.first_response', elapsed)
+    print(f"Respons pertama selesai {elapsed:.2f} detik setelah proses mulai")
 
-    
-    print("Bot siap menerima pesan!")
-    application.run_polling()
+def _import_heavy_modules():
+    from PIL import Image  # noqa: F401
+    import pdf_export  # noqa: F401
+    extraction.get_text_splitter()
+
+async def warm_up():
+    """
+    Dijalankan di latar belakang setelah bot start: mengimpor pustaka berat,
+    menjalankan worker process pool, dan membuka koneksi ke Gemini dan Supabase.
+    Kegagalan hanya dicatat; semuanya tetap diinisialisasi saat pertama dipakai.
+    """
+    async def open_gemini():
+        await run_blocking('gemini', lambda: get_genai().get_model(embedding_model_name))
+
+    async def open_supabase():
+        if VECTOR_STORE == 'supabase':
+            await db_execute(lambda client: client.table('document_catalog').select('user_id').limit(1), stage='supabase.warm_up')
+
+    async def start_workers():
+        pool = get_process_pool()
+        if pool is not None:
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(pool, extraction.warm_up) for _ in range(EXTRACTION_WORKERS)))
+
+    steps = {'gemini': open_gemini(), 'supabase': open_supabase(), 'workers': start_workers(),
+             'modules': asyncio.to_thread(_import_heavy_modules), 'caption_cache': load_caption_cache()}
+    start = time.monotonic()
+    with metrics.span('startup.warm_up'):
+        results = await asyncio.gather(*steps.values(), return_exceptions=True)
+    for name, result in zip(steps, results):
+        if isinstance(result, Exception):
+            print(f"Warm-up {name} gagal: {result}")
+    print(f"Warm-up selesai dalam {time.monotonic() - start:.2f} detik")
+
+_warm_up_task = None
+
+async def on_startup(application: Application):
+    global _warm_up_task
+    await start_metrics_server()
+    ready = time.monotonic() - PROCESS_START
+    metrics.observe('startup.ready', ready)
+    print(f"Bot siap {ready:.2f} detik setelah proses mulai")
+    if WARM_UP:
+        _warm_up_task = asyncio.create_task(warm_up())
+
+def main():
+    check_config()
+    metrics.observe('startup.import', time.monotonic() - PROCESS_START)
+    print("Bot sedang disiapkan...")
+    # Update diproses bersamaan; panggilan API lambat tidak lagi menahan pengguna lain
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES).post_init(on_startup).build()
+    register_handlers(application)
+
+    if WEBHOOK_URL:
+        print(f"Bot menerima update lewat webhook {WEBHOOK_URL}/{WEBHOOK_PATH} (port {WEBHOOK_PORT})")
+        # max_connections: jumlah koneksi HTTPS bersamaan dari Telegram (1-100)
+        application.run_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                                webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                                max_connections=max(1, min(100, CONCURRENT_UPDATES)))
+    else:
+        print("Bot siap menerima pesan!")
+        application.run_polling()
 
 if __name__ == '__main__':
     main()